@@ -81,8 +81,35 @@ class AwsdevhourStack(cdk.Stack):
             partition_key=partition_key,
             removal_policy=cdk.RemovalPolicy.DESTROY,
         )
+        # A user's images newest first, with everything listImages returns projected
+        table.add_global_secondary_index(
+            index_name="ByOwner",
+            partition_key=dynamodb.Attribute(name="owner", type=dynamodb.AttributeType.STRING),
+            sort_key=dynamodb.Attribute(name="uploadTime", type=dynamodb.AttributeType.STRING),
+            projection_type=dynamodb.ProjectionType.ALL,
+        )
         cdk.CfnOutput(self, "ddbTable", value=table.table_name)
 
+        # DynamoDB to cache Rekognition labels by image content, entries expire through TTL
+        label_cache_table = dynamodb.Table(
+            self,
+            "LabelCache",
+            partition_key=dynamodb.Attribute(name="contentKey", type=dynamodb.AttributeType.STRING),
+            billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
+            time_to_live_attribute="expires",
+            removal_policy=cdk.RemovalPolicy.DESTROY,
+        )
+
+        # DynamoDB inverted index of the labels, <owner>#<label> -> images sorted by confidence
+        label_index_table = dynamodb.Table(
+            self,
+            "LabelIndex",
+            partition_key=dynamodb.Attribute(name="label", type=dynamodb.AttributeType.STRING),
+            sort_key=dynamodb.Attribute(name="rank", type=dynamodb.AttributeType.STRING),
+            billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
+            removal_policy=cdk.RemovalPolicy.DESTROY,
+        )
+
         # Lambda layer for Pillow library
         layer = lb.LayerVersion(
             self,
@@ -93,6 +120,59 @@ class AwsdevhourStack(cdk.Stack):
             description="A layer to enable the PIL library in our Rekognition Lambda",
         )
 
+        # DynamoDB ledger of processed object versions so duplicate events are skipped
+        ledger_table = dynamodb.Table(
+            self,
+            "ProcessingLedger",
+            partition_key=dynamodb.Attribute(name="id", type=dynamodb.AttributeType.STRING),
+            billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
+            time_to_live_attribute="expires",
+            removal_policy=cdk.RemovalPolicy.DESTROY,
+        )
+
+        # Lambda layer with the code shared by both of our functions (metrics, AWS clients,
+        # label items and DynamoDB batch reads)
+        shared_layer = lb.LayerVersion(
+            self,
+            "shared",
+            code=lb.Code.from_asset("sharedlayer"),
+            compatible_runtimes=[lb.Runtime.PYTHON_3_7],
+            description="Code shared by the Rekognition and service Lambdas",
+        )
+        # Fraction of invocations emitting EMF metrics
+        metrics_sample_rate = str(self.node.try_get_context("metricsSampleRate") or 1)
+
+        # Throughput knobs for the Rekognition pipeline, set in cdk.json or on the command line
+        # e.g. `cdk deploy -c rekBatchSize=50 -c rekMaxBatchingWindowSeconds=5`
+        rek_timeout_seconds = int(self.node.try_get_context("rekTimeoutSeconds") or 30)
+        rek_batch_size = int(self.node.try_get_context("rekBatchSize") or 10)
+        rek_batching_window_seconds = int(
+            self.node.try_get_context("rekMaxBatchingWindowSeconds") or 0
+        )
+        # SQS only hands a Lambda more than 10 messages at once with a batching window
+        if rek_batch_size > 10 and rek_batching_window_seconds < 1:
+            raise ValueError("rekBatchSize over 10 needs rekMaxBatchingWindowSeconds of at least 1")
+        rek_max_concurrency = self.node.try_get_context("rekMaxConcurrency")
+        # Account wide DetectLabels TPS, shared out between the concurrent functions. Without a
+        # concurrency cap we assume 10 concurrent functions
+        rek_account_tps = float(self.node.try_get_context("rekAccountTps") or 50)
+        rek_tps = rek_account_tps / int(rek_max_concurrency or 10)
+
+        # Each worker holds a decoded image and its renditions. The local harness measures 50 to
+        # 80 MB for one on JPEGs, which are draft decoded at a fraction of their size, and up to
+        # about 150 MB on 12 MP PNG and WebP, which are not. Budget 160 MB for one on top of 256 MB
+        # for the runtime, so more workers need -c rekMemoryMb=... as well
+        rek_memory_mb = int(self.node.try_get_context("rekMemoryMb") or 1024)
+        rek_max_workers = max(1, min(rek_batch_size, 16, (rek_memory_mb - 256) // 160))
+
+        # Thumbnail renditions, see renditionsFromEnv in rekognitionFunction/thumbnails.py
+        thumb_renditions = self.node.try_get_context("thumbRenditions") or [
+            {"name": "", "size": [600, 600]}
+        ]
+        if isinstance(thumb_renditions, str):
+            # -c thumbRenditions='[...]' on the command line arrives as a string
+            thumb_renditions = json.loads(thumb_renditions)
+
         # Lambda function
         rek_fn = lb.Function(
             self,
@@ -100,19 +180,32 @@ class AwsdevhourStack(cdk.Stack):
             code=lb.Code.from_asset("rekognitionFunction"),
             runtime=lb.Runtime.PYTHON_3_7,
             handler="index.handler",
-            timeout=cdk.Duration.seconds(30),
-            memory_size=1024,
-            layers=[layer],
+            timeout=cdk.Duration.seconds(rek_timeout_seconds),
+            memory_size=rek_memory_mb,
+            layers=[layer, shared_layer],
             environment={
                 "TABLE": table.table_name,
                 "BUCKET": image_bucket.bucket_name,
                 "THUMBBUCKET": resized_image_bucket.bucket_name,
+                "LABEL_INDEX_TABLE": label_index_table.table_name,
+                "LABEL_CACHE_TABLE": label_cache_table.table_name,
+                "LEDGER_TABLE": ledger_table.table_name,
+                "LEDGER_LOCK_SECONDS": str(rek_timeout_seconds),
+                "MAX_WORKERS": str(rek_max_workers),
+                "REK_TPS": str(rek_tps),
+                "THUMB_RENDITIONS": json.dumps(thumb_renditions),
+                "METRICS_SAMPLE_RATE": metrics_sample_rate,
             },
         )
 
         image_bucket.grant_read(rek_fn)
-        resized_image_bucket.grant_write(rek_fn)
-        table.grant_write_data(rek_fn)
+        # Read access lets the function HEAD existing thumbnails to skip regenerating them
+        resized_image_bucket.grant_read_write(rek_fn)
+        # Reading the previous labels of an image tells which label index entries are stale
+        table.grant_read_write_data(rek_fn)
+        label_index_table.grant_read_write_data(rek_fn)
+        label_cache_table.grant_read_write_data(rek_fn)
+        ledger_table.grant_read_write_data(rek_fn)
 
         rek_fn.add_to_role_policy(
             iam.PolicyStatement(
@@ -127,16 +220,24 @@ class AwsdevhourStack(cdk.Stack):
             code=lb.Code.from_asset("servicelambda"),
             runtime=lb.Runtime.PYTHON_3_7,
             handler="index.handler",
+            layers=[shared_layer],
+            # Bulk deletes of a whole prefix run for a while, API Gateway gives up after 29 seconds
+            timeout=cdk.Duration.seconds(29),
+            memory_size=512,
             environment={
                 "TABLE": table.table_name,
                 "BUCKET": image_bucket.bucket_name,
                 "RESIZEDBUCKET": resized_image_bucket.bucket_name,
+                "LABEL_INDEX_TABLE": label_index_table.table_name,
+                "URL_EXPIRY": "900",
+                "METRICS_SAMPLE_RATE": metrics_sample_rate,
             },
         )
 
-        image_bucket.grant_write(serviceFn)
-        resized_image_bucket.grant_write(serviceFn)
+        image_bucket.grant_read_write(serviceFn)
+        resized_image_bucket.grant_read_write(serviceFn)
         table.grant_read_write_data(serviceFn)
+        label_index_table.grant_read_write_data(serviceFn)
 
         # Cognito User Pool Auth
         auto_verified_attrs = cognito.AutoVerifiedAttrs(email=True)
@@ -165,9 +266,16 @@ class AwsdevhourStack(cdk.Stack):
             ],
         )
 
+        # serviceFn exchanges the caller's user pool token for their identity id, the <sub> of
+        # the private/<sub>/ prefix their images are under
+        serviceFn.add_environment("IDENTITY_POOL_ID", identity_pool.ref)
+        serviceFn.add_environment("IDENTITY_PROVIDER", user_pool.user_pool_provider_name)
+
         # API Gateway
         cors_options = apigw.CorsOptions(
-            allow_origins=apigw.Cors.ALL_ORIGINS, allow_methods=apigw.Cors.ALL_METHODS
+            allow_origins=apigw.Cors.ALL_ORIGINS,
+            allow_methods=apigw.Cors.ALL_METHODS,
+            allow_headers=apigw.Cors.DEFAULT_HEADERS + ["If-None-Match"],
         )
         api = apigw.LambdaRestApi(
             self,
@@ -240,10 +348,24 @@ class AwsdevhourStack(cdk.Stack):
         cdk.CfnOutput(self, "AppClientId", value=user_pool_client.user_pool_client_id)
         cdk.CfnOutput(self, "IdentityPoolId", value=identity_pool.ref)
 
-        # New Amazon API Gateway with AWS Lambda Integration
+        # New Amazon API Gateway with AWS Lambda Integration. getLabels answers with the ETag of
+        # the label item, and with {"notModified": true, "etag": ...} when the request's
+        # If-None-Match already names it, which the template turns into an empty 304. no-cache
+        # lets browsers keep the labels but makes them revalidate, images without labels yet
+        # must not be cached as such
         success_response = apigw.IntegrationResponse(
             status_code="200",
-            response_parameters={"method.response.header.Access-Control-Allow-Origin": "'*'"},
+            response_parameters={
+                "method.response.header.Access-Control-Allow-Origin": "'*'",
+                "method.response.header.Access-Control-Expose-Headers": "'ETag'",
+                "method.response.header.Cache-Control": "'private, no-cache'",
+                "method.response.header.ETag": "integration.response.body.etag",
+            },
+            response_templates={
+                "application/json": "#if($input.path('$.notModified') == true)"
+                "#set($context.responseOverride.status = 304)"
+                "#else$input.json('$')#end"
+            },
         )
         error_response = apigw.IntegrationResponse(
             selection_pattern="(\n|.)+",
@@ -255,53 +377,103 @@ class AwsdevhourStack(cdk.Stack):
             {
                 "action": "$util.escapeJavaScript($input.params('action'))",
                 "key": "$util.escapeJavaScript($input.params('key'))",
+                "keys": "$util.escapeJavaScript($input.params('keys'))",
+                "prefix": "$util.escapeJavaScript($input.params('prefix'))",
+                "label": "$util.escapeJavaScript($input.params('label'))",
+                "limit": "$util.escapeJavaScript($input.params('limit'))",
+                "cursor": "$util.escapeJavaScript($input.params('cursor'))",
+                "ifNoneMatch": "$util.escapeJavaScript($input.params('If-None-Match'))",
+                # The caller's ID token, which the authorizer has verified, and its sub claim
+                "idToken": "$util.escapeJavaScript($input.params('Authorization'))",
+                "callerSub": "$context.authorizer.claims.sub",
             }
         )
 
+        integration_parameters = {
+            "integration.request.querystring.action": "method.request.querystring.action",
+            "integration.request.querystring.key": "method.request.querystring.key",
+            "integration.request.querystring.keys": "method.request.querystring.keys",
+            "integration.request.querystring.prefix": "method.request.querystring.prefix",
+            "integration.request.querystring.label": "method.request.querystring.label",
+            "integration.request.querystring.limit": "method.request.querystring.limit",
+            "integration.request.querystring.cursor": "method.request.querystring.cursor",
+        }
         lambda_integration = apigw.LambdaIntegration(
             serviceFn,
             proxy=False,
-            request_parameters={
-                "integration.request.querystring.action": "method.request.querystring.action",
-                "integration.request.querystring.key": "method.request.querystring.key",
-            },
+            request_parameters=integration_parameters,
             request_templates={"application/json": request_template},
             passthrough_behavior=apigw.PassthroughBehavior.WHEN_NO_TEMPLATES,
             integration_responses=[success_response, error_response],
         )
+        # Deletes are never cached or answered with a 304, so DELETE gets plain responses
+        delete_success_response = apigw.IntegrationResponse(
+            status_code="200",
+            response_parameters={"method.response.header.Access-Control-Allow-Origin": "'*'"},
+        )
+        delete_integration = apigw.LambdaIntegration(
+            serviceFn,
+            proxy=False,
+            request_parameters=integration_parameters,
+            request_templates={"application/json": request_template},
+            passthrough_behavior=apigw.PassthroughBehavior.WHEN_NO_TEMPLATES,
+            integration_responses=[delete_success_response, error_response],
+        )
 
         imageAPI = api.root.add_resource("images")
 
-        success_resp = apigw.MethodResponse(
-            status_code="200",
-            response_parameters={"method.response.header.Access-Control-Allow-Origin": True},
+        cached_headers = {
+            "method.response.header.Access-Control-Allow-Origin": True,
+            "method.response.header.Access-Control-Expose-Headers": True,
+            "method.response.header.Cache-Control": True,
+            "method.response.header.ETag": True,
+        }
+        success_resp = apigw.MethodResponse(status_code="200", response_parameters=cached_headers)
+        not_modified_resp = apigw.MethodResponse(
+            status_code="304", response_parameters=cached_headers
         )
         error_resp = apigw.MethodResponse(
             status_code="500",
             response_parameters={"method.response.header.Access-Control-Allow-Origin": True},
         )
+        delete_success_resp = apigw.MethodResponse(
+            status_code="200",
+            response_parameters={"method.response.header.Access-Control-Allow-Origin": True},
+        )
 
-        # GET /images
+        # GET /images, getLabelsBatch and getUrls take keys, a JSON array or a comma separated list
+        # of URL encoded keys, instead of a key, and searchByLabel a label. searchByLabel and
+        # listImages page through the caller's own images with limit and cursor
         get_method = imageAPI.add_method(
             "GET",
             lambda_integration,
             authorization_type=apigw.AuthorizationType.COGNITO,
             request_parameters={
                 "method.request.querystring.action": True,
-                "method.request.querystring.key": True,
+                "method.request.querystring.key": False,
+                "method.request.querystring.keys": False,
+                "method.request.querystring.prefix": False,
+                "method.request.querystring.label": False,
+                "method.request.querystring.limit": False,
+                "method.request.querystring.cursor": False,
             },
-            method_responses=[success_resp, error_resp],
+            method_responses=[success_resp, not_modified_resp, error_resp],
         )
-        # DELETE /images
+        # DELETE /images, deleteImages takes keys, as for GET, or a prefix
         delete_method = imageAPI.add_method(
             "DELETE",
-            lambda_integration,
+            delete_integration,
             authorization_type=apigw.AuthorizationType.COGNITO,
             request_parameters={
                 "method.request.querystring.action": True,
-                "method.request.querystring.key": True,
+                "method.request.querystring.key": False,
+                "method.request.querystring.keys": False,
+                "method.request.querystring.prefix": False,
+                "method.request.querystring.label": False,
+                "method.request.querystring.limit": False,
+                "method.request.querystring.cursor": False,
             },
-            method_responses=[success_resp, error_resp],
+            method_responses=[delete_success_resp, error_resp],
         )
 
         # Override the authorizer id because it doesn't work when defininting it as a param
@@ -320,11 +492,15 @@ class AwsdevhourStack(cdk.Stack):
 
         dl_queue_opts = sqs.DeadLetterQueue(max_receive_count=2, queue=dl_queue)
 
+        # Messages stay invisible while they wait for the batching window and through a few
+        # retries of the function (AWS recommends six times the function timeout)
         queue = sqs.Queue(
             self,
             "ImageQueue",
             queue_name="ImageQueue",
-            visibility_timeout=cdk.Duration.seconds(30),
+            visibility_timeout=cdk.Duration.seconds(
+                6 * rek_timeout_seconds + rek_batching_window_seconds
+            ),
             receive_message_wait_time=cdk.Duration.seconds(20),
             dead_letter_queue=dl_queue_opts,
         )
@@ -335,3 +511,24 @@ class AwsdevhourStack(cdk.Stack):
         image_bucket.add_object_created_notification(
             s3n.SqsDestination(queue), s3.NotificationKeyFilter(prefix="private/")
         )
+
+        # Drain the queue with our Rekognition Lambda
+        rek_fn.add_event_source(event_sources.SqsEventSource(queue))
+
+        # SqsEventSource doesn't expose partial batch responses, batching windows, batches over
+        # 10 messages or maximum concurrency in this CDK version, so set them on the underlying
+        # event source mapping. Only the messages listed in the handler's batchItemFailures are
+        # redelivered
+        for child in rek_fn.node.children:
+            if isinstance(child, lb.EventSourceMapping):
+                mapping = child.node.default_child
+                mapping.add_property_override("FunctionResponseTypes", ["ReportBatchItemFailures"])
+                mapping.add_property_override("BatchSize", rek_batch_size)
+                if rek_batching_window_seconds:
+                    mapping.add_property_override(
+                        "MaximumBatchingWindowInSeconds", rek_batching_window_seconds
+                    )
+                if rek_max_concurrency:
+                    mapping.add_property_override(
+                        "ScalingConfig.MaximumConcurrency", int(rek_max_concurrency)
+                    )
@@ -0,0 +1,304 @@
+#
+# Runs rekognitionFunction and servicelambda end to end against the in-memory fakes and
+# reports throughput, latency and memory. Injected faults hit every fake call directly, the
+# SDK retries of a real client don't apply to them, so --rekognition-throttle-rate throttles
+# DetectLabels alone, whose retries are the functions' own. e.g.
+#
+#   python -m localharness --images 200 --batch-size 10 --workers 8 --latency 0.02
+#   python -m localharness --rekognition-throttle-rate 0.2
+#
+
+import argparse
+import contextlib
+import importlib.util
+import io
+import json
+import os
+import resource
+import sys
+import threading
+import time
+import uuid
+from types import SimpleNamespace
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+IMAGE_BUCKET = "harness-images"
+THUMB_BUCKET = "harness-images-resized"
+
+# Tables the stack creates, with their keys and global secondary indexes
+TABLES = {
+    "TABLE": ("harness-labels", "image", None, {"ByOwner": ("owner", "uploadTime")}),
+    "LABEL_CACHE_TABLE": ("harness-label-cache", "contentKey", None, None),
+    "LEDGER_TABLE": ("harness-ledger", "id", None, None),
+    "LABEL_INDEX_TABLE": ("harness-label-index", "label", "rank", None),
+}
+
+
+def loadModule(name, path):
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def context():
+    return SimpleNamespace(
+        aws_request_id=str(uuid.uuid4()), get_remaining_time_in_millis=lambda: 30000
+    )
+
+
+def run(args):
+
+    # The Lambdas read their configuration from the environment at import time
+    os.environ.update(
+        {
+            "BUCKET": IMAGE_BUCKET,
+            "THUMBBUCKET": THUMB_BUCKET,
+            "RESIZEDBUCKET": THUMB_BUCKET,
+            "MAX_WORKERS": str(args.workers),
+            "REK_TPS": str(args.rekognition_tps),
+            "METRICS_SAMPLE_RATE": "0",
+            "IDENTITY_POOL_ID": "harness-identity-pool",
+            "IDENTITY_PROVIDER": "cognito-idp.harness/user-pool",
+            "AWS_DEFAULT_REGION": os.environ.get("AWS_DEFAULT_REGION", "us-east-1"),
+        }
+    )
+    for variable, (table, _, _, _) in TABLES.items():
+        os.environ[variable] = table
+
+    sys.path[:0] = [
+        os.path.join(ROOT, "sharedlayer", "python"),
+        os.path.join(ROOT, "rekognitionFunction"),
+    ]
+    from localharness import corpus
+    from localharness.fakes import (
+        FakeCognitoIdentity,
+        FakeDynamoDB,
+        FakeQueue,
+        FakeRekognition,
+        FakeS3,
+        Faults,
+    )
+    from devhour import clients
+
+    faults = Faults(args.latency, args.jitter, args.error_rate, args.throttle_rate, seed=args.seed)
+    s3 = FakeS3(faults)
+    rekognitionThrottleRate = args.rekognition_throttle_rate
+    if rekognitionThrottleRate is None:
+        rekognitionThrottleRate = args.throttle_rate
+    rekognitionFaults = Faults(
+        args.rekognition_latency,
+        args.jitter,
+        args.error_rate,
+        rekognitionThrottleRate,
+        seed=args.seed,
+    )
+    rekognition = FakeRekognition(s3, rekognitionFaults)
+    dynamodb = FakeDynamoDB(faults)
+    for table, hashKey, rangeKey, indexes in TABLES.values():
+        dynamodb.createTable(table, hashKey, rangeKey, indexes)
+    clients.override("client", "s3", s3)
+    clients.override("client", "rekognition", rekognition)
+    clients.override("resource", "dynamodb", dynamodb)
+    cognitoIdentity = FakeCognitoIdentity()
+    clients.override("client", "cognito-identity", cognitoIdentity)
+
+    # Upload the corpus, queueing one S3 notification per image
+    queue = FakeQueue()
+    keys = []
+    for key, content, _, _ in corpus.generate(
+        args.images, duplicateRate=args.duplicate_rate, seed=args.seed
+    ):
+        with faultsDisabled(faults):
+            eTag = s3.put_object(Bucket=IMAGE_BUCKET, Key=key, Body=content)["ETag"]
+        queue.sendS3Event(IMAGE_BUCKET, key, eTag, len(content))
+        keys.append(key)
+
+    output = io.StringIO()
+    with redirect(output, args.verbose):
+        rekognitionIndex = loadModule(
+            "rekognition_index", os.path.join(ROOT, "rekognitionFunction", "index.py")
+        )
+        serviceIndex = loadModule("service_index", os.path.join(ROOT, "servicelambda", "index.py"))
+
+    # Drain the queue like the event source mapping would, one invocation at a time
+    latencies = []
+    started = time.perf_counter()
+    with redirect(output, args.verbose), RssSampler() as rss:
+        while len(queue):
+            event = queue.receive(args.batch_size)
+            start = time.perf_counter()
+            response = rekognitionIndex.handler(event, context())
+            latencies.append(time.perf_counter() - start)
+            queue.complete(event, response)
+    elapsed = time.perf_counter() - started
+
+    # Read every label back through the service Lambda, one getLabels call per image
+    serviceLatencies = []
+    serviceErrors = 0
+    with redirect(output, args.verbose):
+        for key in keys:
+            start = time.perf_counter()
+            try:
+                serviceIndex.handler({"action": "getLabels", "key": key}, context())
+            except Exception:
+                serviceErrors += 1
+            serviceLatencies.append(time.perf_counter() - start)
+
+    # Page through the images of every user with listImages, like the gallery does
+    listLatencies = []
+    listed = 0
+    tokens = {}
+    with redirect(output, args.verbose):
+        for owner in sorted(set(key.split("/")[1] for key in keys)):
+            cursor = None
+            while True:
+                start = time.perf_counter()
+                try:
+                    # The API's request template always sends a key, empty when it isn't used, and
+                    # the caller's token with its sub claim
+                    event = {
+                        "action": "listImages",
+                        "key": "",
+                        "idToken": tokens.setdefault(owner, cognitoIdentity.signIn(owner)),
+                        "callerSub": f"sub-{owner}",
+                        "cursor": cursor,
+                    }
+                    page = serviceIndex.handler(event, context())
+                except Exception:
+                    serviceErrors += 1
+                    break
+                finally:
+                    listLatencies.append(time.perf_counter() - start)
+                listed += len(page["images"])
+                cursor = page["cursor"]
+                if not cursor:
+                    break
+
+    processed = len(dynamodb.Table(TABLES["TABLE"][0]).items)
+    return {
+        "images": args.images,
+        "batchSize": args.batch_size,
+        "workers": args.workers,
+        "processed": processed,
+        "deadLetters": len(queue.deadLetters),
+        "invocations": len(latencies),
+        "seconds": round(elapsed, 3),
+        "imagesPerSecond": round(processed / elapsed, 2) if elapsed else 0.0,
+        "invocationP50Ms": round(percentile(latencies, 0.5) * 1000, 1),
+        "invocationP99Ms": round(percentile(latencies, 0.99) * 1000, 1),
+        "getLabelsP50Ms": round(percentile(serviceLatencies, 0.5) * 1000, 2),
+        "getLabelsP99Ms": round(percentile(serviceLatencies, 0.99) * 1000, 2),
+        "listedImages": listed,
+        "listImagesP50Ms": round(percentile(listLatencies, 0.5) * 1000, 2),
+        "serviceErrors": serviceErrors,
+        "rekognitionCalls": rekognition.calls,
+        "injected": {
+            name: faults.counts[name] + rekognitionFaults.counts[name] for name in faults.counts
+        },
+        # The corpus is already in memory before the first invocation, so report how far the
+        # resident set grew while the queue drained
+        "baselineRssMb": round(rss.baseline),
+        "pipelineRssMb": round(rss.peak - rss.baseline),
+    }
+
+
+def rssMb():
+    # Current resident set size. ru_maxrss, in kilobytes on Linux, is the fallback where there is
+    # no /proc, and is a peak over the whole run instead
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class RssSampler:
+    # Samples the resident set size on a background thread and keeps the peak
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def __enter__(self):
+        self.baseline = self.peak = rssMb()
+        self.thread = threading.Thread(target=self.sample, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stopped.set()
+        self.thread.join()
+        self.peak = max(self.peak, rssMb())
+
+    def sample(self):
+        while not self.stopped.wait(self.interval):
+            self.peak = max(self.peak, rssMb())
+
+
+@contextlib.contextmanager
+def faultsDisabled(faults):
+    saved = faults.latency, faults.jitter, faults.errorRate, faults.throttleRate
+    faults.latency = faults.jitter = faults.errorRate = faults.throttleRate = 0
+    try:
+        yield
+    finally:
+        faults.latency, faults.jitter, faults.errorRate, faults.throttleRate = saved
+
+
+@contextlib.contextmanager
+def redirect(output, verbose):
+    # The handlers log every image, only show that with --verbose
+    if verbose:
+        yield
+        return
+    with contextlib.redirect_stdout(output):
+        yield
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local end to end harness for the image pipeline")
+    parser.add_argument("--images", type=int, default=100)
+    parser.add_argument("--batch-size", type=int, default=10)
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument(
+        "--latency", type=float, default=0.01, help="S3 and DynamoDB call latency (s)"
+    )
+    parser.add_argument(
+        "--rekognition-latency", type=float, default=0.2, help="DetectLabels latency (s)"
+    )
+    parser.add_argument("--jitter", type=float, default=0.0, help="Extra random latency up to (s)")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument(
+        "--throttle-rate", type=float, default=0.0, help="Throttle rate of every fake"
+    )
+    parser.add_argument(
+        "--rekognition-throttle-rate",
+        type=float,
+        default=None,
+        help="Throttle rate of DetectLabels alone, --throttle-rate by default",
+    )
+    parser.add_argument("--rekognition-tps", type=float, default=50)
+    parser.add_argument("--duplicate-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON")
+    parser.add_argument("--verbose", action="store_true", help="Show the handlers' logs")
+    args = parser.parse_args()
+
+    results = run(args)
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        for name, value in results.items():
+            print(f"{name:>18}: {value}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+#
+# Synthetic image corpus for the local harness
+#
+
+import io
+import random
+
+from PIL import Image
+
+# (width, height) of the generated originals, from small web images to 12 MP phone photos
+SIZES = [(640, 480), (1280, 960), (1920, 1080), (3024, 4032), (4032, 3024)]
+FORMATS = ["JPEG", "PNG", "WEBP"]
+EXTENSIONS = {"JPEG": ".jpg", "PNG": ".png", "WEBP": ".webp"}
+
+
+def makeImage(size, seed):
+
+    # A gradient with some noise and a few shapes compresses like a photo rather than a flat
+    # colour, so encoder and decoder timings are realistic
+    rng = random.Random(seed)
+    base = Image.linear_gradient("L").resize(size).rotate(rng.uniform(0, 360), expand=False)
+    noise = Image.effect_noise(size, rng.uniform(10, 60))
+    image = Image.merge("RGB", (base, noise, Image.blend(base, noise, 0.5)))
+
+    for _ in range(rng.randint(3, 8)):
+        x, y = rng.randrange(size[0]), rng.randrange(size[1])
+        radius = rng.randint(size[0] // 20, size[0] // 5)
+        colour = tuple(rng.randrange(256) for _ in range(3))
+        image.paste(colour, (x, y, min(x + radius, size[0]), min(y + radius, size[1])))
+
+    return image
+
+
+def generate(count, sizes=SIZES, formats=FORMATS, users=4, duplicateRate=0.0, seed=0):
+
+    # Yields (key, bytes, format, size). duplicateRate re-uploads an earlier image under a new
+    # key, like users do, to exercise the label cache
+    rng = random.Random(seed)
+    made = []
+    for n in range(count):
+        user = f"us-east-1:{rng.randrange(users):08x}-0000-0000-0000-000000000000"
+        if made and rng.random() < duplicateRate:
+            _, content, imageFormat, size = rng.choice(made)
+        else:
+            imageFormat, size = rng.choice(formats), rng.choice(sizes)
+            encoded = io.BytesIO()
+            makeImage(size, rng.random()).save(encoded, format=imageFormat, quality=90)
+            content = encoded.getvalue()
+
+        key = f"private/{user}/photo-{n:05d}{EXTENSIONS[imageFormat]}"
+        made.append((key, content, imageFormat, size))
+        yield made[-1]
@@ -0,0 +1,774 @@
+#
+# In-memory stand-ins for the S3, Rekognition, DynamoDB, SQS and Cognito identity APIs our
+# Lambdas use
+#
+
+import copy
+import hashlib
+import io
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from types import SimpleNamespace
+from urllib.parse import quote_plus
+
+from boto3.dynamodb.conditions import ConditionBase, ConditionExpressionBuilder
+from boto3.dynamodb.types import TypeDeserializer, TypeSerializer
+from botocore.exceptions import ClientError
+
+# Error codes each service uses for throttling and for internal failures
+THROTTLE_CODES = {
+    "s3": "SlowDown",
+    "rekognition": "ThrottlingException",
+    "dynamodb": "ProvisionedThroughputExceededException",
+}
+ERROR_CODES = {
+    "s3": "InternalError",
+    "rekognition": "InternalServerError",
+    "dynamodb": "InternalServerError",
+}
+
+
+def clientError(code, operation, message=None):
+    return ClientError({"Error": {"Code": code, "Message": message or code}}, operation)
+
+
+# Latency, error and throttle injection applied to every fake API call
+class Faults:
+    def __init__(self, latency=0.0, jitter=0.0, errorRate=0.0, throttleRate=0.0, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.errorRate = errorRate
+        self.throttleRate = throttleRate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.counts = {"calls": 0, "errors": 0, "throttles": 0}
+
+    def apply(self, service, operation):
+        with self.lock:
+            self.counts["calls"] += 1
+            delay = self.latency + self.random.uniform(0, self.jitter)
+            roll = self.random.random()
+        if delay:
+            time.sleep(delay)
+        if roll < self.throttleRate:
+            self.count("throttles")
+            raise clientError(THROTTLE_CODES[service], operation)
+        if roll < self.throttleRate + self.errorRate:
+            self.count("errors")
+            raise clientError(ERROR_CODES[service], operation)
+
+    def count(self, counter):
+        with self.lock:
+            self.counts[counter] += 1
+
+
+NO_FAULTS = Faults()
+
+
+#
+# S3
+#
+
+
+class FakeS3:
+    def __init__(self, faults=NO_FAULTS):
+        self.faults = faults
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def createBucket(self, bucket):
+        self.buckets.setdefault(bucket, {})
+
+    def _object(self, bucket, key, operation):
+        obj = self.buckets.get(bucket, {}).get(key)
+        if obj is None:
+            raise clientError("NoSuchKey" if operation != "HeadObject" else "404", operation)
+        return obj
+
+    def put_object(
+        self, Bucket, Key, Body=b"", ContentType="binary/octet-stream", Metadata=None, **kwargs
+    ):
+        self.faults.apply("s3", "PutObject")
+        body = Body.read() if hasattr(Body, "read") else bytes(Body)
+        etag = '"' + hashlib.md5(body).hexdigest() + '"'
+        with self.lock:
+            self.buckets.setdefault(Bucket, {})[Key] = {
+                "Body": body,
+                "ETag": etag,
+                "ContentType": ContentType,
+                "Metadata": dict(Metadata or {}),
+                "LastModified": time.time(),
+            }
+        return {"ETag": etag}
+
+    def get_object(self, Bucket, Key, Range=None, **kwargs):
+        self.faults.apply("s3", "GetObject")
+        obj = self._object(Bucket, Key, "GetObject")
+        body = obj["Body"]
+        if Range:
+            start, end = re.match(r"bytes=(\d+)-(\d*)", Range).groups()
+            body = body[int(start) : int(end) + 1 if end else None]
+        return {
+            "Body": io.BytesIO(body),
+            "ETag": obj["ETag"],
+            "ContentLength": len(body),
+            "ContentType": obj["ContentType"],
+            "ContentRange": f"bytes {Range[6:]}/{len(obj['Body'])}" if Range else None,
+            "Metadata": dict(obj["Metadata"]),
+        }
+
+    def head_object(self, Bucket, Key, **kwargs):
+        self.faults.apply("s3", "HeadObject")
+        obj = self._object(Bucket, Key, "HeadObject")
+        return {
+            "ETag": obj["ETag"],
+            "ContentLength": len(obj["Body"]),
+            "ContentType": obj["ContentType"],
+            "Metadata": dict(obj["Metadata"]),
+        }
+
+    def delete_object(self, Bucket, Key, **kwargs):
+        self.faults.apply("s3", "DeleteObject")
+        with self.lock:
+            self.buckets.get(Bucket, {}).pop(Key, None)
+        return {}
+
+    def delete_objects(self, Bucket, Delete, **kwargs):
+        self.faults.apply("s3", "DeleteObjects")
+        with self.lock:
+            for obj in Delete["Objects"]:
+                self.buckets.get(Bucket, {}).pop(obj["Key"], None)
+        deleted = [] if Delete.get("Quiet") else [{"Key": obj["Key"]} for obj in Delete["Objects"]]
+        return {"Deleted": deleted, "Errors": []}
+
+    def list_objects_v2(self, Bucket, Prefix="", ContinuationToken=None, MaxKeys=1000, **kwargs):
+        self.faults.apply("s3", "ListObjectsV2")
+        with self.lock:
+            keys = sorted(key for key in self.buckets.get(Bucket, {}) if key.startswith(Prefix))
+        start = int(ContinuationToken or 0)
+        page = keys[start : start + MaxKeys]
+        response = {"KeyCount": len(page), "Contents": [{"Key": key} for key in page]}
+        if start + MaxKeys < len(keys):
+            response["IsTruncated"] = True
+            response["NextContinuationToken"] = str(start + MaxKeys)
+        return response
+
+    def get_paginator(self, operation):
+        assert operation == "list_objects_v2"
+        fake = self
+
+        class Paginator:
+            def paginate(self, **kwargs):
+                token = None
+                while True:
+                    page = fake.list_objects_v2(ContinuationToken=token, **kwargs)
+                    yield page
+                    token = page.get("NextContinuationToken")
+                    if not token:
+                        return
+
+        return Paginator()
+
+    def generate_presigned_url(self, ClientMethod, Params=None, ExpiresIn=3600, **kwargs):
+        # Signing is local in boto3 too, so no faults are applied
+        Params = Params or {}
+        return (
+            f"https://{Params.get('Bucket')}.s3.local/{Params.get('Key')}?X-Amz-Expires={ExpiresIn}"
+        )
+
+
+#
+# Rekognition
+#
+
+# Labels handed out by the fake, with their parents
+VOCABULARY = [
+    ("Dog", ["Animal", "Pet"]),
+    ("Cat", ["Animal", "Pet"]),
+    ("Person", []),
+    ("Car", ["Vehicle", "Transportation"]),
+    ("Tree", ["Plant"]),
+    ("Beach", ["Nature", "Outdoors"]),
+    ("Building", ["Architecture"]),
+    ("Food", []),
+    ("Sky", ["Nature", "Outdoors"]),
+    ("Flower", ["Plant"]),
+    ("Mountain", ["Nature", "Outdoors"]),
+    ("Bicycle", ["Vehicle", "Transportation"]),
+]
+# Labels that come with bounding boxes, like Rekognition's object labels
+OBJECT_LABELS = {"Dog", "Cat", "Person", "Car", "Bicycle", "Flower"}
+
+
+class FakeRekognition:
+    def __init__(self, s3=None, faults=NO_FAULTS, maxImageBytes=5 * 1024 * 1024):
+        self.s3 = s3
+        self.faults = faults
+        self.maxImageBytes = maxImageBytes
+        self.lock = threading.Lock()
+        self.calls = 0
+
+    def detect_labels(self, Image, MaxLabels=10, MinConfidence=55, **kwargs):
+        self.faults.apply("rekognition", "DetectLabels")
+        with self.lock:
+            self.calls += 1
+
+        if "Bytes" in Image:
+            content = Image["Bytes"]
+            if len(content) > self.maxImageBytes:
+                raise clientError("ImageTooLargeException", "DetectLabels")
+        else:
+            s3Object = Image["S3Object"]
+            response = self.s3.get_object(Bucket=s3Object["Bucket"], Key=s3Object["Name"])
+            content = response["Body"].read()
+
+        # Deterministic labels derived from the content, so identical images get identical labels
+        seed = random.Random(hashlib.sha256(content[:65536]).digest())
+        labels = []
+        for name, parents in seed.sample(VOCABULARY, min(MaxLabels, seed.randint(1, 8))):
+            confidence = round(seed.uniform(50, 99.9), 4)
+            if confidence < MinConfidence:
+                continue
+            instances = []
+            if name in OBJECT_LABELS:
+                for _ in range(seed.randint(1, 3)):
+                    width = round(seed.uniform(0.1, 0.5), 4)
+                    height = round(seed.uniform(0.1, 0.5), 4)
+                    box = {
+                        "Width": width,
+                        "Height": height,
+                        "Left": round(seed.uniform(0, 1 - width), 4),
+                        "Top": round(seed.uniform(0, 1 - height), 4),
+                    }
+                    instances.append({"BoundingBox": box, "Confidence": confidence})
+            labels.append(
+                {
+                    "Name": name,
+                    "Confidence": confidence,
+                    "Instances": instances,
+                    "Parents": [{"Name": parent} for parent in parents],
+                }
+            )
+
+        labels.sort(key=lambda label: -label["Confidence"])
+        return {"Labels": labels, "LabelModelVersion": "fake"}
+
+
+#
+# Cognito identity
+#
+
+
+class FakeCognitoIdentity:
+    # Hands out ID tokens for identity ids, and gives back the identity id of a token like GetId
+    def __init__(self):
+        self.tokens = {}
+        self.calls = 0
+
+    def signIn(self, identityId):
+        token = "token-" + uuid.uuid4().hex
+        self.tokens[token] = identityId
+        return token
+
+    def get_id(self, IdentityPoolId, Logins, **kwargs):
+        self.calls += 1
+        identityIds = [self.tokens.get(token) for token in Logins.values()]
+        if len(identityIds) != 1 or identityIds[0] is None:
+            raise clientError("NotAuthorizedException", "GetId", "Invalid login token")
+        return {"IdentityId": identityIds[0]}
+
+
+#
+# DynamoDB
+#
+
+_serializer = TypeSerializer()
+_deserializer = TypeDeserializer()
+
+
+def _roundTrip(item):
+    # Serialize and deserialize like boto3 does, so floats are rejected and numbers come back
+    # as Decimal exactly as they would from the real service
+    return {
+        key: _deserializer.deserialize(_serializer.serialize(value)) for key, value in item.items()
+    }
+
+
+class _Expression:
+    # Evaluator for the subset of DynamoDB condition and key condition expressions we use:
+    # OR, AND, NOT, parentheses, comparisons, BETWEEN, attribute_exists, attribute_not_exists
+    # and begins_with, with #name and :value placeholders
+
+    TOKEN = re.compile(r"\s*(<>|<=|>=|=|<|>|\(|\)|,|[#:]?[A-Za-z_][A-Za-z0-9_.]*)")
+
+    def __init__(self, expression, names=None, values=None):
+        self.tokens = []
+        position = 0
+        expression = expression.strip()
+        while position < len(expression):
+            match = self.TOKEN.match(expression, position)
+            if not match:
+                raise clientError(
+                    "ValidationException", "Expression", f"Can't parse {expression!r}"
+                )
+            self.tokens.append(match.group(1))
+            position = match.end()
+        self.names = names or {}
+        self.values = values or {}
+
+    def evaluate(self, item):
+        self.position = 0
+        self.item = item
+        result = self._or()
+        if self.position != len(self.tokens):
+            raise clientError("ValidationException", "Expression", "Unexpected trailing tokens")
+        return result
+
+    def _peek(self):
+        return self.tokens[self.position] if self.position < len(self.tokens) else None
+
+    def _next(self):
+        token = self._peek()
+        self.position += 1
+        return token
+
+    def _or(self):
+        result = self._and()
+        while (self._peek() or "").upper() == "OR":
+            self._next()
+            right = self._and()
+            result = result or right
+        return result
+
+    def _and(self):
+        result = self._not()
+        while (self._peek() or "").upper() == "AND":
+            self._next()
+            right = self._not()
+            result = result and right
+        return result
+
+    def _not(self):
+        if (self._peek() or "").upper() == "NOT":
+            self._next()
+            return not self._not()
+        return self._primary()
+
+    def _primary(self):
+        token = self._peek()
+        if token == "(":
+            self._next()
+            result = self._or()
+            self._next()
+            return result
+
+        if token in ("attribute_exists", "attribute_not_exists", "begins_with"):
+            self._next()
+            self._next()
+            arguments = [self._name()]
+            while self._next() == ",":
+                arguments.append(self._operand())
+            if token == "attribute_exists":
+                return arguments[0] in self.item
+            if token == "attribute_not_exists":
+                return arguments[0] not in self.item
+            value = self.item.get(arguments[0])
+            return isinstance(value, str) and value.startswith(arguments[1])
+
+        left = self._operand()
+        operator = self._next()
+        if operator.upper() == "BETWEEN":
+            low = self._operand()
+            self._next()
+            high = self._operand()
+            return left is not None and low <= left <= high
+        right = self._operand()
+        if left is None or right is None:
+            return operator == "<>" and left != right
+        return {
+            "=": left == right,
+            "<>": left != right,
+            "<": left < right,
+            "<=": left <= right,
+            ">": left > right,
+            ">=": left >= right,
+        }[operator]
+
+    def _name(self):
+        token = self._next()
+        return self.names.get(token, token)
+
+    def _operand(self):
+        token = self._peek()
+        if token.startswith(":"):
+            self._next()
+            return self.values[token]
+        return self.item.get(self._name())
+
+
+def _expression(expression, names=None, values=None, isKeyCondition=False):
+    # boto3 condition objects (Key("x").eq(...)) are turned into expression strings first
+    if isinstance(expression, ConditionBase):
+        built = ConditionExpressionBuilder().build_expression(
+            expression, is_key_condition=isKeyCondition
+        )
+        names = dict(names or {}, **built.attribute_name_placeholders)
+        values = dict(values or {}, **built.attribute_value_placeholders)
+        expression = built.condition_expression
+    return _Expression(expression, names, values)
+
+
+def _project(item, projection, names):
+    if not projection:
+        return copy.deepcopy(item)
+    attributes = [names.get(a.strip(), a.strip()) for a in projection.split(",")]
+    return {a: copy.deepcopy(item[a]) for a in attributes if a in item}
+
+
+class FakeTable:
+    def __init__(self, resource, name, hashKey, rangeKey=None, indexes=None):
+        self.resource = resource
+        self.name = name
+        self.table_name = name
+        self.hashKey = hashKey
+        self.rangeKey = rangeKey
+        # {index name: (hash key, range key or None)}
+        self.indexes = indexes or {}
+        self.items = {}
+        self.lock = threading.RLock()
+        self.meta = SimpleNamespace(client=resource.client)
+
+    @property
+    def faults(self):
+        return self.resource.faults
+
+    def _key(self, item):
+        return (item[self.hashKey], item.get(self.rangeKey) if self.rangeKey else None)
+
+    def _check(self, existing, condition, names, values, operation):
+        if condition is None:
+            return
+        if not _expression(condition, names, values).evaluate(existing or {}):
+            raise clientError(
+                "ConditionalCheckFailedException", operation, "The conditional request failed"
+            )
+
+    def get_item(self, Key, ProjectionExpression=None, ExpressionAttributeNames=None, **kwargs):
+        self.faults.apply("dynamodb", "GetItem")
+        with self.lock:
+            item = self.items.get(self._key(Key))
+            if item is None:
+                return {}
+            return {"Item": _project(item, ProjectionExpression, ExpressionAttributeNames or {})}
+
+    def put_item(
+        self,
+        Item,
+        ConditionExpression=None,
+        ExpressionAttributeNames=None,
+        ExpressionAttributeValues=None,
+        **kwargs,
+    ):
+        self.faults.apply("dynamodb", "PutItem")
+        item = _roundTrip(Item)
+        with self.lock:
+            existing = self.items.get(self._key(item))
+            self._check(
+                existing,
+                ConditionExpression,
+                ExpressionAttributeNames,
+                ExpressionAttributeValues,
+                "PutItem",
+            )
+            self.items[self._key(item)] = item
+        return {}
+
+    def update_item(
+        self,
+        Key,
+        UpdateExpression,
+        ConditionExpression=None,
+        ExpressionAttributeNames=None,
+        ExpressionAttributeValues=None,
+        **kwargs,
+    ):
+        # Only SET a = :a, b = :b updates are supported
+        self.faults.apply("dynamodb", "UpdateItem")
+        names = ExpressionAttributeNames or {}
+        values = _roundTrip(ExpressionAttributeValues or {})
+        with self.lock:
+            existing = self.items.get(self._key(Key))
+            self._check(existing, ConditionExpression, names, values, "UpdateItem")
+            item = dict(existing or _roundTrip(Key))
+            assignments = re.sub(r"^\s*SET\s+", "", UpdateExpression, flags=re.IGNORECASE)
+            for assignment in assignments.split(","):
+                name, value = (part.strip() for part in assignment.split("="))
+                item[names.get(name, name)] = values[value]
+            self.items[self._key(item)] = item
+        return {}
+
+    def delete_item(
+        self,
+        Key,
+        ConditionExpression=None,
+        ExpressionAttributeNames=None,
+        ExpressionAttributeValues=None,
+        **kwargs,
+    ):
+        self.faults.apply("dynamodb", "DeleteItem")
+        with self.lock:
+            existing = self.items.get(self._key(Key))
+            self._check(
+                existing,
+                ConditionExpression,
+                ExpressionAttributeNames,
+                ExpressionAttributeValues,
+                "DeleteItem",
+            )
+            self.items.pop(self._key(Key), None)
+        if kwargs.get("ReturnValues") == "ALL_OLD" and existing is not None:
+            return {"Attributes": copy.deepcopy(existing)}
+        return {}
+
+    def query(
+        self,
+        KeyConditionExpression,
+        IndexName=None,
+        ScanIndexForward=True,
+        Limit=None,
+        ExclusiveStartKey=None,
+        ProjectionExpression=None,
+        ExpressionAttributeNames=None,
+        ExpressionAttributeValues=None,
+        **kwargs,
+    ):
+        self.faults.apply("dynamodb", "Query")
+        hashKey, rangeKey = self.indexes[IndexName] if IndexName else (self.hashKey, self.rangeKey)
+        condition = _expression(
+            KeyConditionExpression,
+            ExpressionAttributeNames,
+            ExpressionAttributeValues,
+            isKeyCondition=True,
+        )
+        with self.lock:
+            matches = [
+                item
+                for item in self.items.values()
+                if hashKey in item
+                and (rangeKey is None or rangeKey in item)
+                and condition.evaluate(item)
+            ]
+
+        # Order by range key then table key, the way a GSI orders items with equal range keys
+        def order(item):
+            return (item.get(rangeKey) if rangeKey else "", str(self._key(item)))
+
+        matches.sort(key=order, reverse=not ScanIndexForward)
+        if ExclusiveStartKey:
+            start = order(_roundTrip(ExclusiveStartKey))
+            matches = [
+                i
+                for i in matches
+                if (order(i) < start if not ScanIndexForward else order(i) > start)
+            ]
+
+        page = matches[:Limit] if Limit else matches
+        response = {
+            "Items": [
+                _project(item, ProjectionExpression, ExpressionAttributeNames or {})
+                for item in page
+            ],
+            "Count": len(page),
+        }
+        if Limit and len(matches) > Limit:
+            last = page[-1]
+            lastKey = {self.hashKey: last[self.hashKey]}
+            if self.rangeKey:
+                lastKey[self.rangeKey] = last[self.rangeKey]
+            if IndexName:
+                lastKey[hashKey] = last[hashKey]
+                if rangeKey:
+                    lastKey[rangeKey] = last[rangeKey]
+            response["LastEvaluatedKey"] = lastKey
+        return response
+
+    def scan(self, **kwargs):
+        self.faults.apply("dynamodb", "Scan")
+        with self.lock:
+            items = [copy.deepcopy(item) for item in self.items.values()]
+        return {"Items": items, "Count": len(items)}
+
+    def batch_writer(self, overwrite_by_pkeys=None):
+        return _BatchWriter(self)
+
+
+class _BatchWriter:
+    def __init__(self, table):
+        self.table = table
+        self.requests = []
+
+    def put_item(self, Item):
+        self.requests.append({"PutRequest": {"Item": Item}})
+
+    def delete_item(self, Key):
+        self.requests.append({"DeleteRequest": {"Key": Key}})
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        # Like boto3, keep sending the unprocessed requests until everything is written
+        pending = self.requests
+        while pending:
+            chunk, pending = pending[:25], pending[25:]
+            response = self.table.meta.client.batch_write_item(
+                RequestItems={self.table.name: chunk}
+            )
+            pending = response["UnprocessedItems"].get(self.table.name, []) + pending
+        return False
+
+
+class _FakeDynamoClient:
+    # The low level client behind FakeDynamoDB.meta.client, with boto3's native type handling
+    def __init__(self, resource):
+        self.resource = resource
+
+    def batch_write_item(self, RequestItems, **kwargs):
+        faults = self.resource.faults
+        faults.apply("dynamodb", "BatchWriteItem")
+        unprocessed = {}
+        for name, requests in RequestItems.items():
+            if len(requests) > 25:
+                raise clientError("ValidationException", "BatchWriteItem", "Too many items")
+            table = self.resource.Table(name)
+            for request in requests:
+                # Throttling shows up as unprocessed items rather than an error
+                if faults.random.random() < faults.throttleRate:
+                    faults.count("throttles")
+                    unprocessed.setdefault(name, []).append(request)
+                    continue
+                with table.lock:
+                    if "PutRequest" in request:
+                        item = _roundTrip(request["PutRequest"]["Item"])
+                        table.items[table._key(item)] = item
+                    else:
+                        table.items.pop(table._key(request["DeleteRequest"]["Key"]), None)
+        return {"UnprocessedItems": unprocessed}
+
+    def batch_get_item(self, RequestItems, **kwargs):
+        return self.resource.batch_get_item(RequestItems=RequestItems)
+
+
+class FakeDynamoDB:
+    # Stands in for boto3.resource("dynamodb")
+    def __init__(self, faults=NO_FAULTS):
+        self.faults = faults
+        self.tables = {}
+        self.client = _FakeDynamoClient(self)
+        self.meta = SimpleNamespace(client=self.client)
+
+    def createTable(self, name, hashKey, rangeKey=None, indexes=None):
+        self.tables[name] = FakeTable(self, name, hashKey, rangeKey, indexes)
+        return self.tables[name]
+
+    def Table(self, name):
+        if name not in self.tables:
+            raise clientError(
+                "ResourceNotFoundException", "DescribeTable", f"Table {name} not found"
+            )
+        return self.tables[name]
+
+    def batch_get_item(self, RequestItems, **kwargs):
+        self.faults.apply("dynamodb", "BatchGetItem")
+        responses, unprocessed = {}, {}
+        for name, request in RequestItems.items():
+            if len(request["Keys"]) > 100:
+                raise clientError("ValidationException", "BatchGetItem", "Too many keys")
+            table = self.Table(name)
+            names = request.get("ExpressionAttributeNames", {})
+            for key in request["Keys"]:
+                if self.faults.random.random() < self.faults.throttleRate:
+                    self.faults.count("throttles")
+                    unprocessed.setdefault(name, dict(request, Keys=[]))["Keys"].append(key)
+                    continue
+                with table.lock:
+                    item = table.items.get(table._key(key))
+                if item is not None:
+                    responses.setdefault(name, []).append(
+                        _project(item, request.get("ProjectionExpression"), names)
+                    )
+        return {"Responses": responses, "UnprocessedKeys": unprocessed}
+
+
+#
+# SQS
+#
+
+
+class FakeQueue:
+    # Queue of S3 event notifications, redelivering the messages a handler reports as failed
+    # until maxReceiveCount is reached, after which they move to the dead letter list
+    def __init__(self, maxReceiveCount=2):
+        self.maxReceiveCount = maxReceiveCount
+        self.messages = []
+        self.inFlight = {}
+        self.deadLetters = []
+        self.sequencer = 0
+
+    def sendS3Event(self, bucket, key, eTag, size):
+        # S3 URL encodes the keys in its notifications
+        key = quote_plus(key, safe="/")
+        self.sequencer += 1
+        record = {
+            "eventTime": time.strftime("%Y-%m-%dT%H:%M:%S.000Z", time.gmtime()),
+            "eventName": "ObjectCreated:Put",
+            "s3": {
+                "bucket": {"name": bucket},
+                "object": {
+                    "key": key,
+                    "eTag": eTag.strip('"'),
+                    "size": size,
+                    "sequencer": f"{self.sequencer:016X}",
+                },
+            },
+        }
+        self.messages.append(
+            {
+                "messageId": str(uuid.uuid4()),
+                "body": json.dumps({"Records": [record]}),
+                "receiveCount": 0,
+            }
+        )
+
+    def receive(self, batchSize):
+        batch, self.messages = self.messages[:batchSize], self.messages[batchSize:]
+        for message in batch:
+            message["receiveCount"] += 1
+            self.inFlight[message["messageId"]] = message
+        return {
+            "Records": [
+                {"messageId": m["messageId"], "body": m["body"], "eventSource": "aws:sqs"}
+                for m in batch
+            ]
+        }
+
+    def complete(self, event, response):
+        # Apply the handler's partial batch response
+        failed = {
+            failure["itemIdentifier"] for failure in (response or {}).get("batchItemFailures", [])
+        }
+        for record in event["Records"]:
+            message = self.inFlight.pop(record["messageId"])
+            if record["messageId"] not in failed:
+                continue
+            if message["receiveCount"] >= self.maxReceiveCount:
+                self.deadLetters.append(message)
+            else:
+                self.messages.append(message)
+
+    def __len__(self):
+        return len(self.messages)
@@ -0,0 +1,90 @@
+#
+# Idempotency ledger so duplicate S3 events and SQS redeliveries don't reprocess an image
+#
+
+import logging
+import time
+
+from botocore.exceptions import ClientError
+
+IN_PROGRESS = "IN_PROGRESS"
+COMPLETE = "COMPLETE"
+# Originals we will never process, e.g. too large, so redeliveries and duplicates are skipped
+REJECTED = "REJECTED"
+
+
+class DuplicateInProgress(Exception):
+    # Another invocation is processing the same object version right now. Failing the message
+    # lets SQS redeliver it later, by which time the ledger says COMPLETE and it is skipped
+    pass
+
+
+# Records each object version we process in a DynamoDB table. A conditional write claims the
+# version as IN_PROGRESS until lockSeconds have passed, so a crashed invocation doesn't block
+# it forever, and the entry is marked COMPLETE once the labels are stored. Entries expire
+# through the table's TTL attribute after ttlSeconds
+class ProcessingLedger:
+    def __init__(self, table, lockSeconds=60, ttlSeconds=7 * 24 * 3600):
+        self.table = table
+        self.lockSeconds = lockSeconds
+        self.ttlSeconds = ttlSeconds
+
+    @staticmethod
+    def ledgerKey(record):
+        # versionId identifies the object version on versioned buckets, otherwise the sequencer
+        # orders the events of a key, and the ETag is a last resort
+        s3Object = record["s3"]["object"]
+        version = s3Object.get("versionId") or s3Object.get("sequencer") or s3Object.get("eTag", "")
+        return f"{record['s3']['bucket']['name']}/{s3Object['key']}#{version}"
+
+    def begin(self, key):
+        # Returns True when we claimed the key and should process it, False when it's done
+        now = int(time.time())
+        try:
+            self.table.put_item(
+                Item={
+                    "id": key,
+                    "status": IN_PROGRESS,
+                    "lockedUntil": now + self.lockSeconds,
+                    "expires": now + self.ttlSeconds,
+                },
+                ConditionExpression="attribute_not_exists(id) OR (#s = :inProgress AND lockedUntil < :now)",
+                ExpressionAttributeNames={"#s": "status"},
+                ExpressionAttributeValues={":inProgress": IN_PROGRESS, ":now": now},
+            )
+            return True
+        except ClientError as e:
+            if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                raise
+
+        item = self.table.get_item(Key={"id": key}, ConsistentRead=True).get("Item", {})
+        if item.get("status") in (COMPLETE, REJECTED):
+            return False
+        raise DuplicateInProgress(f"{key} is already being processed")
+
+    def completedItem(self, key):
+        # Ledger item marking key COMPLETE, written in batches along with the labels
+        return {"id": key, "status": COMPLETE, "expires": int(time.time()) + self.ttlSeconds}
+
+    def reject(self, key, reason):
+        # Mark key as never to be processed, replacing our IN_PROGRESS claim
+        self.table.put_item(
+            Item={
+                "id": key,
+                "status": REJECTED,
+                "reason": reason,
+                "expires": int(time.time()) + self.ttlSeconds,
+            }
+        )
+
+    def release(self, key):
+        # Give up our claim after a failure so a redelivery can process the key straight away
+        try:
+            self.table.delete_item(
+                Key={"id": key},
+                ConditionExpression="#s = :inProgress",
+                ExpressionAttributeNames={"#s": "status"},
+                ExpressionAttributeValues={":inProgress": IN_PROGRESS},
+            )
+        except ClientError as e:
+            logging.error(e)
@@ -3,77 +3,321 @@
 #
 
 import logging
-import boto3
 from botocore.exceptions import ClientError
+from devhour import clients, labels, metrics, tables
 import os
 from urllib.parse import unquote_plus
-from boto3.dynamodb.conditions import Key, Attr
+import io
 import json
-import uuid
-from PIL import Image
+import random
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+# Pillow is the biggest import of our cold start, it's timed on its own
+with metrics.importTimer("thumbnails"):
+    from thumbnails import (
+        analysisJpeg,
+        decode,
+        makeRenditions,
+        outputFormat,
+        probeHeader,
+        profileVersion,
+        renditionKey,
+        renditionsFromEnv,
+    )
+with metrics.importTimer("helpers"):
+    from idempotency import ProcessingLedger
+    from labelcache import LabelCache
+    from throttling import CircuitBreaker, ThrottledCaller, TokenBucket
 
 thumbBucket = os.environ["THUMBBUCKET"]
+# Upper bound on the number of images processed at the same time within one invocation
+maxWorkers = int(os.environ.get("MAX_WORKERS", "8"))
+# Sizes, formats and resampling settings of the thumbnails generated for each image
+thumbRenditions = renditionsFromEnv()
+thumbVersion = profileVersion(thumbRenditions)
+# THUMB_FORCE regenerates thumbnails even when the existing ones are up to date
+forceThumbnails = os.environ.get("THUMB_FORCE", "").lower() in ("1", "true", "yes")
 # Set the minimum confidence for Amazon Rekognition
 
 minConfidence = 50
+# Maximum number of labels we store per image
+maxLabels = 10
+# "bytes" sends Rekognition a downsampled copy of the image we decoded for the thumbnails,
+# "s3" lets Rekognition read the original from S3 again (limited to 15 MB originals)
+analysisInput = os.environ.get("REK_INPUT_MODE", "bytes")
+# Long edge of the image sent to Rekognition in bytes mode
+analysisEdge = int(os.environ.get("ANALYSIS_MAX_EDGE", "1920"))
+
+# The header probe reads PROBE_BYTES of the original first, growing up to PROBE_MAX_BYTES when
+# the header doesn't fit. Originals over MAX_PIXELS (Pillow's decompression bomb limit by
+# default) or MAX_ORIGINAL_BYTES are rejected before we download them
+probeBytes = int(os.environ.get("PROBE_BYTES", 64 * 1024))
+probeMaxBytes = int(os.environ.get("PROBE_MAX_BYTES", 256 * 1024))
+maxPixels = int(os.environ.get("MAX_PIXELS", 89478485))
+maxOriginalBytes = int(os.environ.get("MAX_ORIGINAL_BYTES", 50 * 1024 * 1024))
 
 """MinConfidence parameter (float) -- Specifies the minimum confidence level for the labels to return.
 Amazon Rekognition doesn't return any labels with a confidence lower than this specified value.
 If you specify a value of 0, all labels are returned, regardless of the default thresholds that the
 model version applies."""
 
-## Instantiate service clients outside of handler for context reuse / performance
+## Service clients come from devhour.clients, built on first use and reused by later invocations
 
-# Constructor for our s3 client object
-s3_client = boto3.client("s3")
-# Constructor to create rekognition client object
-rekognition_client = boto3.client("rekognition")
-# Constructor for DynamoDB resource object
-dynamodb = boto3.resource("dynamodb")
+# Every worker thread shares one token bucket sized to this container's share of the
+# account's DetectLabels TPS, and one breaker that stops calls while we're being throttled
+rekognitionCaller = ThrottledCaller(
+    TokenBucket(float(os.environ.get("REK_TPS", "5"))),
+    CircuitBreaker(
+        failureThreshold=int(os.environ.get("REK_BREAKER_FAILURES", "5")),
+        resetSeconds=float(os.environ.get("REK_BREAKER_RESET_SECONDS", "10")),
+    ),
+)
 
 
-def handler(event, context):
+# DynamoDB table our labels are written to
+@clients.once
+def getImageLabelsTable():
+    return clients.resource("dynamodb").Table(os.environ["TABLE"])
 
-    print("Lambda processing event: ", event)
 
-    # For each message (photo) get the bucket name and key
-    for response in event["Records"]:
-        formatted = json.loads(response["body"])
-        for record in formatted["Records"]:
-            ourBucket = record["s3"]["bucket"]["name"]
-            ourKey = record["s3"]["object"]["key"]
+# Inverted index of the labels, label name -> images sorted by confidence
+@clients.once
+def getLabelIndexTable():
+    if not os.environ.get("LABEL_INDEX_TABLE"):
+        return None
+    return clients.resource("dynamodb").Table(os.environ["LABEL_INDEX_TABLE"])
 
-        # For each bucket/key, retrieve labels
-        generateThumb(ourBucket, ourKey)
-        rekFunction(ourBucket, ourKey)
 
-    return
+# Labels of images we have already seen, keyed by their content
+@clients.once
+def getLabelCache():
+    if not os.environ.get("LABEL_CACHE_TABLE"):
+        return None
+    return LabelCache(
+        clients.resource("dynamodb").Table(os.environ["LABEL_CACHE_TABLE"]),
+        ttlSeconds=int(os.environ.get("LABEL_CACHE_TTL", str(30 * 24 * 3600))),
+        maxLocalItems=int(os.environ.get("LABEL_CACHE_LOCAL_ITEMS", "1024")),
+    )
 
 
-def rekFunction(ourBucket, ourKey):
+# Object versions we have already processed, so duplicates short-circuit
+@clients.once
+def getLedger():
+    if not os.environ.get("LEDGER_TABLE"):
+        return None
+    return ProcessingLedger(
+        clients.resource("dynamodb").Table(os.environ["LEDGER_TABLE"]),
+        lockSeconds=int(os.environ.get("LEDGER_LOCK_SECONDS", "60")),
+    )
 
-    # Clean the string to add the colon back into requested name which was substitued by Amplify Library.
-    safeKey = replaceSubstringWithColon(ourKey)
 
-    print("Currently processing the following image")
-    print("Bucket: " + ourBucket + " key name: " + safeKey)
+# Pool running the independent stages (thumbnail, labels) of each image side by side
+stageExecutor = ThreadPoolExecutor(max_workers=2 * maxWorkers)
+# Pool shared by all images of an invocation to upload their renditions concurrently
+uploadExecutor = ThreadPoolExecutor(max_workers=int(os.environ.get("UPLOAD_WORKERS", "8")))
 
-    # Try and retrieve labels from Amazon Rekognition, using the confidence level we set in minConfidence var
+
+def handler(event, context):
+
+    # Log a summary rather than the whole event, timings and counts go out as one EMF line
+    print("Lambda processing messages: ", len(event["Records"]))
+    metrics.begin("rekognitionFunction", requestId=getattr(context, "aws_request_id", None))
     try:
-        detectLabelsResults = rekognition_client.detect_labels(
-            Image={"S3Object": {"Bucket": ourBucket, "Name": safeKey}},
-            MaxLabels=10,
-            MinConfidence=minConfidence,
+        return processBatch(event)
+    finally:
+        metrics.flush()
+
+
+def processBatch(event):
+
+    failedMessages = []
+    futures = []
+
+    # Fan out every bucket/key of every message (photo) in the batch onto a bounded pool.
+    # boto3 clients are thread safe, so all workers share the clients from devhour.clients.
+    with ThreadPoolExecutor(max_workers=maxWorkers) as executor:
+        for message in event["Records"]:
+            try:
+                records = json.loads(message["body"]).get("Records", [])
+            except ValueError as e:
+                logging.error(e)
+                failedMessages.append(message["messageId"])
+                continue
+
+            for record in records:
+                futures.append(
+                    (message["messageId"], record, executor.submit(processRecord, record))
+                )
+    metrics.add("images", len(futures))
+
+    # A message fails if any of its images failed, the rest are deleted from the queue
+    labelItems = {}
+    for messageId, record, future in futures:
+        try:
+            item = future.result()
+        except Exception as e:
+            logging.error(e)
+            if messageId not in failedMessages:
+                failedMessages.append(messageId)
+            continue
+
+        # Images the ledger says are already processed have nothing left to write
+        if item is not None:
+            entry = labelItems.setdefault(
+                item["image"], {"item": item, "messages": [], "records": []}
+            )
+            entry["messages"].append(messageId)
+            entry["records"].append(record)
+
+    # The label index goes first, so when it can't be updated the previous labels of the image
+    # are still there to work out the stale entries on redelivery
+    with metrics.timer("labelIndexWrite"):
+        unindexedImages = updateLabelIndex(labelItems)
+
+    # Write the labels of the whole batch at once, failing the messages of unwritten items
+    with metrics.timer("dynamodbWrite"):
+        unwritten = batchWriteItems(
+            getImageLabelsTable(),
+            [entry["item"] for image, entry in labelItems.items() if image not in unindexedImages],
         )
+    unwrittenImages = unindexedImages | set(item["image"] for item in unwritten)
+    for image in unwrittenImages:
+        for messageId in labelItems[image]["messages"]:
+            if messageId not in failedMessages:
+                failedMessages.append(messageId)
+
+    # Mark what we stored as complete in the ledger and release the rest for the redelivery
+    ledger = getLedger()
+    if ledger is not None:
+        completed = []
+        for image, entry in labelItems.items():
+            for record in entry["records"]:
+                if image in unwrittenImages:
+                    ledger.release(ProcessingLedger.ledgerKey(record))
+                else:
+                    completed.append(ledger.completedItem(ProcessingLedger.ledgerKey(record)))
+        batchWriteItems(ledger.table, completed)
+
+    metrics.add("failedMessages", len(failedMessages))
+
+    # Partial batch response, only the failed messages are redelivered by SQS
+    return {"batchItemFailures": [{"itemIdentifier": m} for m in failedMessages]}
+
+
+def processRecord(record):
+
+    # For each bucket/key, create the thumbnail and retrieve labels
+    ourBucket = record["s3"]["bucket"]["name"]
+    ourKey = record["s3"]["object"]["key"]
+    ourETag = record["s3"]["object"].get("eTag")
+
+    # Claim this object version, duplicates of a processed one stop here
+    ledger = getLedger()
+    ledgerKey = None
+    if ledger is not None:
+        ledgerKey = ProcessingLedger.ledgerKey(record)
+        if not ledger.begin(ledgerKey):
+            print("Skipping already processed image: " + ourKey)
+            return None
 
-    except ClientError as e:
+    try:
+        return processImage(ourBucket, ourKey, ourETag, record.get("eventTime"))
+    except OriginalRejected as e:
+        # Redelivering the message won't make the original any smaller, so acknowledge it and
+        # have the ledger skip this version from now on
         logging.error(e)
+        if ledgerKey is not None:
+            ledger.reject(ledgerKey, str(e))
+        return None
+    except Exception:
+        if ledgerKey is not None:
+            ledger.release(ledgerKey)
+        raise
+
+
+def processImage(ourBucket, ourKey, ourETag, eventTime=None):
+
+    # The thumbnail and the Rekognition call don't depend on each other, so start both
+    # at once and wait for the slower one. In bytes mode the Rekognition stage gets the image
+    # decoded by the thumbnail stage through a future, it only waits for it on a cache miss.
+    # Either way it waits for the thumbnail stage's probe to admit the original before calling
+    # DetectLabels, so rejected originals are never sent to Rekognition
+    decoded = Future() if analysisInput == "bytes" else None
+    admitted = Future()
+    rekognition = stageExecutor.submit(
+        runStage, "labels", rekFunction, ourBucket, ourKey, ourETag, decoded, admitted
+    )
+    results = {
+        "thumbnail": runStage(
+            "thumbnail", generateThumb, ourBucket, ourKey, ourETag, decoded, admitted
+        )
+    }
+    results["labels"] = rekognition.result()
+
+    if (
+        decoded is not None
+        and decoded.done()
+        and decoded.exception() is None
+        and decoded.result() is not None
+    ):
+        decoded.result().close()
+
+    errors = {name: error for name, (_, error) in results.items() if error is not None}
+    if isinstance(errors.get("thumbnail"), OriginalRejected):
+        raise errors["thumbnail"]
+    if errors:
+        raise StageError(ourKey, errors)
+
+    # The label item also describes the image and its thumbnails, and records who uploaded it
+    # when, for the owner index to list a user's images newest first
+    item = results["labels"][0]
+    item.update(results["thumbnail"][0])
+    owner = labels.ownerOf(item["image"])
+    if owner is not None:
+        item["owner"] = owner
+    item["uploadTime"] = eventTime or time.strftime("%Y-%m-%dT%H:%M:%S.000Z", time.gmtime())
+    # getLabels answers conditional requests with it
+    item["etag"] = labels.itemETag(item)
+    return item
+
+
+class StageError(Exception):
+    # Raised when any stage of an image failed, naming every failed stage
+    def __init__(self, key, errors):
+        self.errors = errors
+        details = "; ".join(f"{name}: {error!r}" for name, error in errors.items())
+        super().__init__(f"Processing {key} failed in {details}")
+
+
+def runStage(name, function, *args):
+
+    # Returns (result, error) instead of raising, so every stage gets timed and reported
+    with metrics.timer(name):
+        try:
+            return function(*args), None
+        except Exception as e:
+            metrics.add(name + "Errors")
+            return None, e
+
+
+def rekFunction(ourBucket, ourKey, ourETag=None, decoded=None, admitted=None):
+
+    # Clean the string to add the colon back into requested name which was substitued by Amplify Library.
+    safeKey = replaceSubstringWithColon(ourKey)
+
+    print("Currently processing the following image")
+    print("Bucket: " + ourBucket + " key name: " + safeKey)
+
+    detectLabelsResults = detectLabels(ourBucket, safeKey, ourETag, decoded, admitted)
 
     # Create our array and dict for our label construction
 
     objectsDetected = []
 
-    imageLabels = {"image": safeKey}
+    # The full labels with confidences, parents and bounding boxes, next to the flat
+    # object1..objectN names existing readers use
+    imageLabels = {"image": safeKey, "labels": labels.labelList(detectLabelsResults["Labels"])}
 
     # Add all of our labels into imageLabels by iterating over response['Labels']
 
@@ -86,55 +330,341 @@ def rekFunction(ourBucket, ourKey):
         # We now have our shiny new item ready to put into DynamoDB
         imageLabels[itemAtt] = newItem
 
-    # Instantiate a table resource object of our environment variable
-    imageLabelsTable = os.environ["TABLE"]
-    table = dynamodb.Table(imageLabelsTable)
+    # The handler writes the items of the whole batch together
+    return imageLabels
+
+
+def updateLabelIndex(labelItems):
+
+    # Index the labels of every image and remove the entries of the labels the previous version
+    # of the image had and this one hasn't. Returns the images whose index is not up to date
+    index = getLabelIndexTable()
+    if index is None or not labelItems:
+        return set()
+
+    previous, unread = tables.batchGetItems(
+        getImageLabelsTable(), list(labelItems), ["image", "labels"]
+    )
+    entries = []
+    stale = []
+    for image, entry in labelItems.items():
+        if image in unread:
+            continue
+        current = labels.indexEntries(image, entry["item"]["labels"])
+        ranks = set((e["label"], e["rank"]) for e in current)
+        entries.extend(current)
+        stale.extend(
+            key
+            for key in labels.indexKeys(image, previous.get(image, {}).get("labels", []))
+            if (key["label"], key["rank"]) not in ranks
+        )
+
+    unwritten = batchWriteItems(index, entries, stale)
+    metrics.add("labelIndexEntries", len(entries))
+    return unread | set(labels.rankImage(item["rank"]) for item in unwritten)
+
+
+def batchWriteItems(table, items, deleteKeys=(), maxAttempts=5):
+
+    # batch_write_item takes at most 25 requests per call. Requests DynamoDB leaves unprocessed
+    # are retried with jittered exponential backoff, the items (or keys to delete) still
+    # unwritten are returned
+    requests = [{"PutRequest": {"Item": item}} for item in items]
+    requests += [{"DeleteRequest": {"Key": key}} for key in deleteKeys]
+
+    unwritten = []
+    for start in range(0, len(requests), 25):
+        chunk = requests[start : start + 25]
+
+        for attempt in range(maxAttempts):
+            if attempt:
+                time.sleep(random.uniform(0, 0.05 * 2**attempt))
+            try:
+                response = table.meta.client.batch_write_item(RequestItems={table.name: chunk})
+            except ClientError as e:
+                logging.error(e)
+                break
+            chunk = response.get("UnprocessedItems", {}).get(table.name, [])
+            if not chunk:
+                break
+
+        unwritten.extend(
+            (
+                request["PutRequest"]["Item"]
+                if "PutRequest" in request
+                else request["DeleteRequest"]["Key"]
+            )
+            for request in chunk
+        )
 
-    # Put item into table
+    return unwritten
+
+
+def detectLabels(ourBucket, safeKey, ourETag=None, decoded=None, admitted=None):
+
+    # Identical content re-uploaded under another key has the same ETag, reuse its labels
+    cacheKey = None
+    labelCache = getLabelCache()
+    if labelCache is not None:
+        if ourETag is None:
+            head = clients.client("s3").head_object(Bucket=ourBucket, Key=unquote_plus(safeKey))
+            ourETag = head["ETag"]
+        cacheKey = LabelCache.cacheKey(ourETag.strip('"'), maxLabels, minConfidence)
+        cachedLabels = labelCache.get(cacheKey)
+        if cachedLabels is not None:
+            metrics.add("labelCacheHits")
+            return {"Labels": cachedLabels}
+        metrics.add("labelCacheMisses")
+
+    # Raises OriginalRejected when the thumbnail stage's probe found the original too large
+    if admitted is not None:
+        admitted.result()
+
+    # Send the already decoded image when we have it, otherwise let Rekognition read it from S3.
+    # The thumbnail stage hands over None when the thumbnails were up to date and it never
+    # decoded the original
+    source = decoded.result() if decoded is not None else None
+    if source is not None:
+        image = {"Bytes": analysisJpeg(source, analysisEdge)}
+        metrics.add("analysisBytes", len(image["Bytes"]), "Bytes")
+    else:
+        image = {"S3Object": {"Bucket": ourBucket, "Name": safeKey}}
+
+    # Try and retrieve labels from Amazon Rekognition, using the confidence level we set in minConfidence var
     try:
-        table.put_item(Item=imageLabels)
+        with metrics.timer("rekognition"):
+            detectLabelsResults = rekognitionCaller.call(
+                clients.client("rekognition").detect_labels,
+                Image=image,
+                MaxLabels=maxLabels,
+                MinConfidence=minConfidence,
+            )
+
     except ClientError as e:
         logging.error(e)
+        raise
+
+    if cacheKey is not None:
+        labelCache.put(cacheKey, detectLabelsResults["Labels"])
 
-    return
+    return detectLabelsResults
 
 
-def generateThumb(ourBucket, ourKey):
+def generateThumb(ourBucket, ourKey, ourETag=None, decoded=None, admitted=None):
 
     # Clean the string to add the colon back into requested name
     safeKey = replaceSubstringWithColon(ourKey)
-
-    # Define upload and download paths
     key = unquote_plus(safeKey)
-    tmpkey = key.replace("/", "")
-    download_path = "/tmp/{}{}".format(uuid.uuid4(), tmpkey)
-    upload_path = "/tmp/resized-{}".format(tmpkey)
 
-    # Download file from s3 and store it in Lambda /tmp storage (512MB avail)
     try:
-        s3_client.download_file(ourBucket, key, download_path)
-    except ClientError as e:
-        logging.error(e)
-    # Create our thumbnail using Pillow library
-    resize_image(download_path, upload_path)
-
-    # Upload the thumbnail to the thumbnail bucket
-    try:
-        s3_client.upload_file(upload_path, thumbBucket, safeKey)
+        # Redrives and backfills mostly find thumbnails made from the same original with the
+        # same renditions, one HEAD is enough to skip the download, decode and encode
+        current = None
+        if ourETag is not None and not forceThumbnails:
+            current = currentThumbnails(safeKey, ourETag)
+        if current is not None:
+            metrics.add("thumbnailsSkipped")
+            if admitted is not None:
+                admitted.set_result(True)
+            if decoded is not None:
+                decoded.set_result(None)
+            # What the probe found out when the thumbnails were made
+            return imageDetails(
+                safeKey,
+                current.get("source-format"),
+                current.get("source-width"),
+                current.get("source-height"),
+                current.get("source-orientation"),
+            )
+
+        # Look at the header before paying for the whole original
+        with metrics.timer("probe"):
+            header, probe, size, sourceETag = probeOriginal(ourBucket, key)
+        metrics.add("probeBytes", len(header), "Bytes")
+        if size > maxOriginalBytes or (probe and probe["size"][0] * probe["size"][1] > maxPixels):
+            metrics.add("originalsRejected")
+            rejected = OriginalRejected(key, size, probe)
+            for future in (admitted, decoded):
+                if future is not None:
+                    future.set_exception(rejected)
+            raise rejected
+        if admitted is not None:
+            admitted.set_result(True)
+
+        # Read the rest of the original straight into memory, nothing touches Lambda /tmp
+        # storage. Small originals were read whole by the probe
+        with metrics.timer("download"):
+            original = io.BytesIO(header)
+            original.seek(0, io.SEEK_END)
+            if len(header) < size:
+                response = clients.client("s3").get_object(
+                    Bucket=ourBucket, Key=key, Range=f"bytes={len(header)}-", IfMatch=sourceETag
+                )
+                original.write(response["Body"].read())
+            original.seek(0)
+        metrics.add("downloadedBytes", size, "Bytes")
+
+        # Decode once, sharing the image with the Rekognition stage
+        with metrics.timer("decode"):
+            image = decode(original, thumbRenditions, analysisEdge if decoded is not None else None)
+        metrics.add("decodedPixels", image.size[0] * image.size[1])
+        # The decoded image may be a JPEG draft, only the probe knows the size of the original
+        width, height = probe["size"] if probe else image.size
+        details = imageDetails(
+            safeKey, image.format, width, height, probe["orientation"] if probe else None
+        )
+        if decoded is not None:
+            decoded.set_result(image)
+
+        # Create our thumbnails using Pillow library
+        with metrics.timer("resize"):
+            renditions = resize_image(image)
+
+        # Every rendition records what it was made from. The primary rendition is the one
+        # currentThumbnails checks, so it goes up only once all the others are in place
+        metadata = {
+            "source-etag": (ourETag or sourceETag).strip('"'),
+            "profile-version": thumbVersion,
+        }
+        metadata.update(probeMetadata(probe))
+        primary = [r for r in renditions if r[0] is thumbRenditions[0]][:1]
+        others = [r for r in renditions if r not in primary]
+
+        # Upload the other renditions to the thumbnail bucket at the same time, then the primary
+        with metrics.timer("upload"):
+            for batch in (others, primary):
+                uploads = [
+                    uploadExecutor.submit(
+                        clients.client("s3").put_object,
+                        Bucket=thumbBucket,
+                        Key=renditionKey(safeKey, profile, imageFormat),
+                        Body=thumbnail.getvalue(),
+                        ContentType=contentType,
+                        Metadata=metadata,
+                    )
+                    for profile, imageFormat, (thumbnail, contentType) in batch
+                ]
+                for upload in uploads:
+                    upload.result()
+        metrics.add(
+            "thumbnailBytes", sum(t.getbuffer().nbytes for _, _, (t, _) in renditions), "Bytes"
+        )
     except ClientError as e:
         logging.error(e)
+        raise
+    finally:
+        # Never leave the Rekognition stage waiting for an image that won't come
+        if admitted is not None and not admitted.done():
+            admitted.set_exception(RuntimeError("The original could not be probed"))
+        if decoded is not None and not decoded.done():
+            decoded.set_exception(RuntimeError("The original could not be downloaded or decoded"))
+
+    return details
+
+
+def imageDetails(safeKey, imageFormat, width=None, height=None, orientation=None):
+
+    # Size of the original and where each of its renditions is stored, for the label item
+    thumbnails = []
+    for profile in thumbRenditions:
+        renditionFormat = outputFormat(profile, imageFormat)
+        thumbnail = {
+            "key": renditionKey(safeKey, profile, renditionFormat),
+            "name": profile.name,
+            "format": renditionFormat,
+        }
+        if thumbnail not in thumbnails:
+            thumbnails.append(thumbnail)
+
+    details = {"thumbnails": thumbnails}
+    if width and height:
+        details.update(width=int(width), height=int(height))
+    if orientation:
+        details["orientation"] = int(orientation)
+    return details
+
+
+def probeOriginal(ourBucket, key):
+
+    # Range-fetch the start of the original and read its header, fetching more (up to
+    # probeMaxBytes) for headers that don't fit, like JPEGs with large EXIF previews.
+    # Returns (bytes read, header or None, size of the original, ETag)
+    s3 = clients.client("s3")
+    header = b""
+    end = probeBytes
+    conditions = {}
+    while True:
+        response = s3.get_object(
+            Bucket=ourBucket, Key=key, Range=f"bytes={len(header)}-{end - 1}", **conditions
+        )
+        header += response["Body"].read()
+        contentRange = response.get("ContentRange")
+        size = int(contentRange.rsplit("/", 1)[1]) if contentRange else len(header)
+        # Every later range has to come from the same version of the original
+        conditions = {"IfMatch": response["ETag"]}
+
+        try:
+            return header, probeHeader(header), size, response["ETag"]
+        except Exception:
+            if len(header) >= size:
+                # That was the whole object and it still isn't an image we can read
+                raise
+            if end >= probeMaxBytes:
+                # Decoding the whole original will tell
+                return header, None, size, response["ETag"]
+        end = min(end * 4, probeMaxBytes)
+
+
+class OriginalRejected(Exception):
+    # Raised for originals too large to process, before they are downloaded
+    def __init__(self, key, size, probe):
+        dimensions = "x".join(map(str, probe["size"])) if probe else "unknown size"
+        super().__init__(f"{key} is too large to process ({size} bytes, {dimensions})")
+
+
+def probeMetadata(probe):
+
+    # What the probe learnt about the original, as S3 user metadata on every rendition.
+    # S3 metadata has to be ASCII
+    if probe is None:
+        return {}
+    metadata = {
+        "source-format": probe["format"],
+        "source-width": str(probe["size"][0]),
+        "source-height": str(probe["size"][1]),
+        "source-orientation": str(probe["orientation"]),
+    }
+    for name, value in probe["exif"].items():
+        metadata["source-" + name] = (
+            value.encode("ascii", "ignore").decode("ascii").strip("\x00 ")[:128]
+        )
+    return metadata
 
-    # Be good little citizens and clean up files in /tmp so that we don't run out of space
-    os.remove(upload_path)
-    os.remove(download_path)
-
-    return
 
+def currentThumbnails(safeKey, ourETag):
 
-def resize_image(image_path, resized_path):
-    with Image.open(image_path) as image:
-        image.thumbnail(tuple(x / 2 for x in image.size))
-        image.save(resized_path)
+    # The metadata of the primary rendition when it was made from this version of the original
+    # with the renditions we are configured for now, None otherwise
+    try:
+        response = clients.client("s3").head_object(
+            Bucket=thumbBucket, Key=renditionKey(safeKey, thumbRenditions[0])
+        )
+    except ClientError:
+        # Missing (or not readable), make it
+        return None
+
+    metadata = response.get("Metadata", {})
+    if (
+        metadata.get("source-etag") == ourETag.strip('"')
+        and metadata.get("profile-version") == thumbVersion
+    ):
+        return metadata
+    return None
+
+
+def resize_image(image, profiles=thumbRenditions):
+    # Encode every rendition of the decoded image into its own buffer
+    return makeRenditions(image, profiles)
 
 
 # Clean the string to add the colon back into requested name
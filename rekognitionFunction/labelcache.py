@@ -0,0 +1,59 @@
+#
+# Content addressed cache of Amazon Rekognition labels
+#
+
+import json
+import logging
+import time
+
+from botocore.exceptions import ClientError
+from devhour.lru import LruCache
+
+
+# Caches detect_labels results by content hash and request parameters. Lookups go to an
+# in-process LRU first, so warm containers answer repeated uploads without a network call,
+# then to a DynamoDB table shared by all containers whose items expire through its TTL attribute
+class LabelCache:
+
+    def __init__(self, table, ttlSeconds=30 * 24 * 3600, maxLocalItems=1024):
+        self.table = table
+        self.ttlSeconds = ttlSeconds
+        self.local = LruCache(maxLocalItems)
+
+    @staticmethod
+    def cacheKey(contentHash, maxLabels, minConfidence):
+        # The same bytes analysed with other parameters give other labels
+        return f"{contentHash}#{maxLabels}#{minConfidence}"
+
+    def get(self, key):
+        labels = self.local.get(key)
+        if labels is not None:
+            return labels
+
+        try:
+            item = self.table.get_item(Key={"contentKey": key}).get("Item")
+        except ClientError as e:
+            # The cache is an optimisation, never fail the image because of it
+            logging.error(e)
+            item = None
+
+        # DynamoDB deletes expired items lazily, so check the expiry ourselves
+        if item is None or int(item["expires"]) < time.time():
+            return None
+
+        labels = json.loads(item["labels"])
+        self.local.put(key, labels)
+        return labels
+
+    def put(self, key, labels):
+        self.local.put(key, labels)
+        try:
+            self.table.put_item(
+                Item={
+                    "contentKey": key,
+                    "labels": json.dumps(labels),
+                    "expires": int(time.time()) + self.ttlSeconds,
+                }
+            )
+        except ClientError as e:
+            logging.error(e)
@@ -0,0 +1,121 @@
+#
+# Client side rate limiting, backoff and circuit breaking shared by the worker threads
+#
+
+import random
+import threading
+import time
+
+from botocore.exceptions import ClientError
+
+# Error codes AWS services use to tell us to slow down
+THROTTLING_ERRORS = {
+    "ThrottlingException",
+    "ProvisionedThroughputExceededException",
+    "LimitExceededException",
+    "TooManyRequestsException",
+    "RequestLimitExceeded",
+    "SlowDown",
+}
+
+
+def isThrottle(error):
+    return isinstance(error, ClientError) and error.response["Error"]["Code"] in THROTTLING_ERRORS
+
+
+class RateLimited(Exception):
+    # No token became available in time, the call was not made
+    pass
+
+
+class CircuitOpen(Exception):
+    # The service kept throttling us, calls are refused until the breaker resets
+    pass
+
+
+# Token bucket refilled at `rate` tokens per second, holding at most `capacity` tokens
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else max(rate, 1))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, timeout=None):
+        # Blocks until a token is available, returns False if that takes longer than timeout
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return True
+                wait = (1 - self.tokens) / self.rate
+
+            if deadline is not None:
+                if now + wait > deadline:
+                    return False
+            time.sleep(wait)
+
+
+# Opens after failureThreshold consecutive throttles and refuses calls for resetSeconds,
+# then lets calls through again and closes on the first success
+class CircuitBreaker:
+    def __init__(self, failureThreshold=5, resetSeconds=10):
+        self.failureThreshold = failureThreshold
+        self.resetSeconds = resetSeconds
+        self.failures = 0
+        self.openUntil = 0
+        self.lock = threading.Lock()
+
+    def check(self):
+        with self.lock:
+            if time.monotonic() < self.openUntil:
+                raise CircuitOpen("Circuit open after repeated throttling")
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.failureThreshold:
+                self.openUntil = time.monotonic() + self.resetSeconds
+
+
+# Makes calls through the rate limiter and breaker, retrying throttles with full jitter
+# exponential backoff. Other errors are raised straight away
+class ThrottledCaller:
+    def __init__(
+        self, limiter, breaker, maxAttempts=4, baseDelay=0.1, maxDelay=2.0, acquireTimeout=5.0
+    ):
+        self.limiter = limiter
+        self.breaker = breaker
+        self.maxAttempts = maxAttempts
+        self.baseDelay = baseDelay
+        self.maxDelay = maxDelay
+        self.acquireTimeout = acquireTimeout
+
+    def call(self, function, **kwargs):
+        for attempt in range(self.maxAttempts):
+            self.breaker.check()
+            if not self.limiter.acquire(self.acquireTimeout):
+                raise RateLimited("No capacity left within the rate limit")
+
+            try:
+                result = function(**kwargs)
+            except ClientError as e:
+                if not isThrottle(e):
+                    raise
+                self.breaker.failure()
+                if attempt == self.maxAttempts - 1:
+                    raise
+                time.sleep(random.uniform(0, min(self.maxDelay, self.baseDelay * 2**attempt)))
+                continue
+
+            self.breaker.success()
+            return result
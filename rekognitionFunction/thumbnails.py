@@ -0,0 +1,308 @@
+#
+# Thumbnail profiles used by the Rekognition Lambda to size its thumbnails
+#
+
+import hashlib
+import io
+import json
+import math
+import os
+import posixpath
+from dataclasses import dataclass
+from PIL import Image, features
+
+# Only register the plugins of the formats we accept. Image.open(formats=ACCEPTED_FORMATS) and
+# save() with one of their formats then never import every other plugin Pillow ships with,
+# except to identify a file none of these accept, which fails either way
+from PIL import GifImagePlugin, JpegImagePlugin, PngImagePlugin, WebPImagePlugin  # noqa: F401
+
+ACCEPTED_FORMATS = ("JPEG", "PNG", "WEBP", "GIF")
+
+RESAMPLE_FILTERS = {
+    "nearest": Image.NEAREST,
+    "box": Image.BOX,
+    "bilinear": Image.BILINEAR,
+    "hamming": Image.HAMMING,
+    "bicubic": Image.BICUBIC,
+    "lanczos": Image.LANCZOS,
+}
+
+# EXIF tags of IFD0 we keep from the probe
+EXIF_TAGS = {0x010F: "make", 0x0110: "model", 0x0132: "datetime"}
+ORIENTATION_TAG = 0x0112
+
+# Extensions appended to the key of a rendition with an explicit output format
+FORMAT_EXTENSIONS = {"JPEG": ".jpg", "PNG": ".png", "WEBP": ".webp", "GIF": ".gif"}
+
+# Encoder speed/size trade-offs. method is the WebP effort from 0 (fastest) to 6 (smallest),
+# optimize makes an extra pass over JPEG and PNG output to shrink it
+ENCODER_PRESETS = {
+    "fast": {"method": 0, "optimize": False},
+    "balanced": {"method": 4, "optimize": False},
+    "small": {"method": 6, "optimize": True},
+}
+
+# WebP needs the _webp module built into the layer's Pillow, without it we fall back to JPEG
+WEBP_SUPPORTED = features.check_module("webp")
+
+
+@dataclass(frozen=True)
+class ThumbnailProfile:
+    # Rendition name, appended to the key of the original. An empty name stores the
+    # rendition under the key of the original itself
+    name: str = ""
+    # Bounding box (width, height) the thumbnail has to fit in
+    size: tuple = (600, 600)
+    # Output format, None keeps the format of the original
+    format: str = None
+    # Encoder quality for lossy formats, None uses the Pillow default. For lossless WebP it is
+    # the compression effort instead
+    quality: int = None
+    # One of ENCODER_PRESETS, None uses the Pillow defaults
+    preset: str = None
+    # WebP encoder method from 0 (fast) to 6 (small), overrides the preset
+    method: int = None
+    # Lossless WebP, for screenshots and drawings that lossy WebP would smear
+    lossless: bool = False
+    # Filter used for the final resample
+    resample: int = Image.BICUBIC
+    # The image is first reduced (draft decoding for JPEG, then Image.reduce) to about
+    # reducing_gap times the target size and only the rest is resampled. None always
+    # resamples from the full size image, which is slower but slightly sharper
+    reducing_gap: float = 2.0
+
+
+def profileFromEnv():
+
+    # THUMB_SIZE as "<width>x<height>", THUMB_RESAMPLE as one of RESAMPLE_FILTERS and
+    # THUMB_REDUCING_GAP as a float or "none"
+    width, height = os.environ.get("THUMB_SIZE", "600x600").lower().split("x")
+    resample = RESAMPLE_FILTERS[os.environ.get("THUMB_RESAMPLE", "bicubic").lower()]
+    reducingGap = os.environ.get("THUMB_REDUCING_GAP", "2.0")
+    reducingGap = None if reducingGap.lower() == "none" else float(reducingGap)
+
+    return ThumbnailProfile(
+        size=(int(width), int(height)), resample=resample, reducing_gap=reducingGap
+    )
+
+
+def renditionsFromEnv():
+
+    # THUMB_RENDITIONS is a JSON list of renditions, e.g.
+    # [{"name": "", "size": [600, 600]}, {"name": "grid", "size": [200, 200], "format": "JPEG", "quality": 75}]
+    # A rendition with "formats" instead of "format" is produced once in each of them, e.g.
+    # {"name": "grid", "size": [200, 200], "formats": ["WEBP", "JPEG"], "preset": "balanced"}
+    # Without it we produce the single rendition described by THUMB_SIZE
+    renditions = os.environ.get("THUMB_RENDITIONS")
+    if not renditions:
+        return [profileFromEnv()]
+
+    default = profileFromEnv()
+    profiles = []
+    for rendition in json.loads(renditions):
+        resample = rendition.get("resample")
+        preset = rendition.get("preset")
+        if preset is not None and preset not in ENCODER_PRESETS:
+            raise ValueError(f"Unknown encoder preset {preset}")
+        for imageFormat in rendition.get("formats") or [rendition.get("format")]:
+            profiles.append(
+                ThumbnailProfile(
+                    name=rendition.get("name", ""),
+                    size=tuple(rendition["size"]),
+                    format=imageFormat.upper() if imageFormat else None,
+                    quality=rendition.get("quality"),
+                    preset=preset,
+                    method=rendition.get("method"),
+                    lossless=rendition.get("lossless", False),
+                    resample=RESAMPLE_FILTERS[resample] if resample else default.resample,
+                    reducing_gap=rendition.get("reducing_gap", default.reducing_gap),
+                )
+            )
+
+    return profiles
+
+
+def profileVersion(profiles):
+
+    # Changes whenever the renditions we would produce change, so thumbnails made with another
+    # configuration (or before WebP support was in the layer) are regenerated
+    config = repr((profiles, ENCODER_PRESETS, WEBP_SUPPORTED))
+    return hashlib.sha256(config.encode("utf-8")).hexdigest()[:16]
+
+
+def outputFormat(profile, sourceFormat):
+
+    # The format a rendition is actually encoded in
+    imageFormat = profile.format or sourceFormat
+    if imageFormat == "WEBP" and not WEBP_SUPPORTED:
+        return "JPEG"
+    return imageFormat
+
+
+def renditionKey(key, profile, imageFormat=None):
+
+    # private/<sub>/photo.jpg becomes private/<sub>/photo-grid.jpg for the "grid" rendition.
+    # A rendition with an explicit format also gets that format's extension, so the front end
+    # can ask for photo-grid.jpg.webp when the browser accepts WebP and photo-grid.jpg.jpg
+    # otherwise, whatever the original was
+    if profile.name:
+        root, ext = posixpath.splitext(key)
+        key = f"{root}-{profile.name}{ext}"
+    if profile.format:
+        key += FORMAT_EXTENSIONS[imageFormat or outputFormat(profile, None)]
+    return key
+
+
+def probeHeader(data):
+
+    # Reads format, size, orientation and a few EXIF fields from the first bytes of an image.
+    # The JPEG, PNG and GIF plugins only parse headers when the image is opened, but the WebP
+    # plugin hands the whole file to libwebp, so WebP sizes come from the RIFF chunk instead.
+    # Raises like Image.open when the data is too short
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return {"format": "WEBP", "size": webpSize(data), "orientation": 1, "exif": {}}
+
+    image = Image.open(io.BytesIO(data), formats=ACCEPTED_FORMATS)
+    # A PNG without an eXIf chunk ahead of its pixels would be loaded in full looking for one
+    if image.format == "PNG" and "exif" not in image.info:
+        exif = {}
+    else:
+        exif = image.getexif()
+
+    return {
+        "format": image.format,
+        "size": image.size,
+        "orientation": exif.get(ORIENTATION_TAG, 1),
+        "exif": {name: str(exif[tag]) for tag, name in EXIF_TAGS.items() if tag in exif},
+    }
+
+
+def webpSize(data):
+
+    # Canvas size from the first chunk of a simple (VP8, VP8L) or extended (VP8X) WebP file
+    if len(data) < 30:
+        raise SyntaxError("Truncated WebP header")
+    chunk = data[12:16]
+    if chunk == b"VP8X":
+        return 1 + int.from_bytes(data[24:27], "little"), 1 + int.from_bytes(data[27:30], "little")
+    if chunk == b"VP8 ":
+        return (
+            int.from_bytes(data[26:28], "little") & 0x3FFF,
+            int.from_bytes(data[28:30], "little") & 0x3FFF,
+        )
+    if chunk == b"VP8L":
+        bits = int.from_bytes(data[21:25], "little")
+        return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+    raise SyntaxError(f"Unknown WebP chunk {chunk!r}")
+
+
+def decode(original, profiles, analysisEdge=None):
+
+    # Decode the original once at the smallest scale that still serves every rendition and the
+    # Rekognition analysis image, so all of them can be derived from the same pixels
+    image = Image.open(original, formats=ACCEPTED_FORMATS)
+
+    # draft() picks the largest libjpeg scale that keeps both dimensions at least as large as the
+    # requested size, so ask for what each rendition fits the image to times its reducing gap,
+    # and for the analysis image's long edge. Sizes keep the aspect ratio of the image, a square
+    # box would hold the short edge of a photo or panorama to the box's long edge
+    if None not in [profile.reducing_gap for profile in profiles]:
+        requested = [
+            tuple(
+                math.ceil(edge * profile.reducing_gap)
+                for edge in fittedSize(image.size, profile.size)
+            )
+            for profile in profiles
+        ]
+        if analysisEdge:
+            requested.append(fittedSize(image.size, (analysisEdge, analysisEdge)))
+        image.draft(None, (max(w for w, _ in requested), max(h for _, h in requested)))
+
+    image.load()
+    return image
+
+
+def makeThumbnail(image, profile):
+
+    # Image.thumbnail calls draft() with reducing_gap times the target size before loading the
+    # image, so with a fixed bounding box libjpeg decodes large photos at 1/2, 1/4 or 1/8 scale
+    # instead of decoding every pixel and throwing most of them away
+    image.thumbnail(profile.size, resample=profile.resample, reducing_gap=profile.reducing_gap)
+
+    return image
+
+
+def fittedSize(size, box):
+    # Size Image.thumbnail gives an image of this size in this box, give or take rounding
+    scale = min(box[0] / size[0], box[1] / size[1], 1)
+    return max(1, int(size[0] * scale)), max(1, int(size[1] * scale))
+
+
+def makeRenditions(image, profiles):
+
+    # Start from the decoded image for the largest rendition, then derive each smaller rendition
+    # from the previous one when it is still at least as large as the rendition it has to make.
+    # Boxes don't have to nest (a wide banner after a square), so otherwise go back to the
+    # decoded image. The decoded image may be shared with the analysis stage, so it is only
+    # ever copied, never modified
+    ordered = sorted(profiles, key=lambda p: p.size[0] * p.size[1], reverse=True)
+    sourceFormat = image.format
+
+    renditions = []
+    current = image
+    for profile in ordered:
+        target = fittedSize(image.size, profile.size)
+        source = current if current.width >= target[0] and current.height >= target[1] else image
+        # Image.thumbnail leaves an image that already fits alone, so renditions of the same
+        # size in different formats are resampled only once
+        current = makeThumbnail(source.copy(), profile)
+        imageFormat = outputFormat(profile, sourceFormat)
+        encoded = encode(
+            current, imageFormat, profile.quality, encoderOptions(profile, imageFormat)
+        )
+        renditions.append((profile, imageFormat, encoded))
+
+    return renditions
+
+
+def encoderOptions(profile, imageFormat):
+
+    options = dict(ENCODER_PRESETS.get(profile.preset, {}))
+    if profile.method is not None:
+        options["method"] = profile.method
+    if imageFormat == "WEBP":
+        options.pop("optimize", None)
+        if profile.lossless:
+            options["lossless"] = True
+    else:
+        options.pop("method", None)
+    return options
+
+
+def encode(image, imageFormat, quality=None, options=None):
+
+    # JPEG has no alpha channel or palette, flatten those first
+    if imageFormat == "JPEG" and image.mode not in ("RGB", "L", "CMYK"):
+        image = image.convert("RGB")
+
+    options = dict(options or {})
+    if quality is not None:
+        options["quality"] = quality
+    encoded = io.BytesIO()
+    image.save(encoded, format=imageFormat, **options)
+
+    return encoded, Image.MIME.get(imageFormat, "application/octet-stream")
+
+
+def analysisJpeg(image, maxEdge, maxBytes=5 * 1024 * 1024):
+
+    # Rekognition finds labels just as well on a downsampled image, and image bytes sent
+    # inline must stay under 5 MB. Shrink further in the rare case the JPEG is still too big
+    analysis = image.copy()
+    quality = 90
+    while True:
+        analysis.thumbnail((maxEdge, maxEdge), resample=Image.BILINEAR)
+        encoded, _ = encode(analysis, "JPEG", quality)
+        if encoded.tell() <= maxBytes:
+            return encoded.getvalue()
+        maxEdge, quality = int(maxEdge * 0.75), max(quality - 10, 60)
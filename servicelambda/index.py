@@ -1,14 +1,68 @@
 import logging
-import boto3
-from botocore.exceptions import ClientError
+from devhour import metrics
+import json
 import os
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import unquote
 
-# Constructors for Amazon DynamoDB and S3 resource object
-dynamodb = boto3.resource("dynamodb")
-s3 = boto3.resource("s3")
+# Cold start imports are timed against the same budget as the Rekognition function's. botocore
+# is the biggest of them, boto3 itself is only imported with the first client
+with metrics.importTimer("botocore"):
+    from botocore.exceptions import ClientError
+with metrics.importTimer("helpers"):
+    from devhour import clients, labels, tables
+    from devhour.lru import LruCache
+
+# DynamoDB caps batch_get_item at 100 keys per request
+maxBatchKeys = 100
+# S3 caps delete_objects at 1000 keys per request
+maxDeleteKeys = 1000
+# Attributes of a label item, rekFunction stores at most 10 labels per image
+labelAttributes = ["image", "labels"] + [f"object{n}" for n in range(1, 11)]
+# Pages of search results hold defaultPageSize items unless the request asks for a limit
+defaultPageSize = 25
+maxPageSize = 100
+# Lifetime of pre-signed URLs in seconds. They are signed with the function's role credentials
+# and stop working when those expire, whatever the expiry, so keep it short
+urlExpiry = min(int(os.environ.get("URL_EXPIRY", "900")), 7 * 24 * 3600)
+# Global secondary index of the label table by owner and upload time
+ownerIndex = os.environ.get("OWNER_INDEX", "ByOwner")
+
+# Amazon DynamoDB and S3 clients come from devhour.clients, built on first use so that
+# getLabels never pays for an S3 client it doesn't need
+
+# Label items of the images asked for most, kept by a warm container for LABELS_CACHE_TTL
+# seconds so other writers' changes show up soon enough. 0 items disables it
+labelsCache = LruCache(
+    int(os.environ.get("LABELS_CACHE_ITEMS", "1024")),
+    ttlSeconds=float(os.environ.get("LABELS_CACHE_TTL", "60")),
+)
+# Cognito identity ids of the callers this container has seen, by the sub claim of their user
+# pool token. A user's identity id never changes, so the entries don't expire
+callerIdentities = LruCache(int(os.environ.get("CALLER_CACHE_ITEMS", "1024")))
+
+
+# DynamoDB table the labels are read from
+@clients.once
+def getImageLabelsTable():
+    return clients.resource("dynamodb").Table(os.environ["TABLE"])
 
 
 def handler(event, context):
+    # Time every action and emit it as one EMF line per invocation
+    metrics.begin(
+        "serviceFunction",
+        action=event.get("action"),
+        requestId=getattr(context, "aws_request_id", None),
+    )
+    try:
+        with metrics.timer("action"):
+            return dispatch(event)
+    finally:
+        metrics.flush()
+
+
+def dispatch(event):
     # Detect requested action from the Amazon API Gateway event
     action = event["action"]
     image = event["key"]
@@ -18,32 +72,130 @@ def handler(event, context):
     # GET request from API
     if action == "getLabels":
         getResults = getLabelsFunction(imageRequest)
+        # Hit ratio of this container's cache since it started, next to the per invocation
+        # hit and miss counts
+        stats = labelsCache.stats()
+        metrics.put(
+            "labelsCacheHitRatio",
+            100.0 * stats["hits"] / (stats["hits"] + stats["misses"]),
+            "Percent",
+        )
         if "image" in getResults:
-            return getResults
+            # Items written before the ETag was stored get the same one computed here
+            etag = getResults.get("etag") or labels.itemETag(getResults)
+            if labels.etagMatches(etag, event.get("ifNoneMatch")):
+                # The API's response template turns this into an empty 304 Not Modified
+                metrics.add("notModified")
+                return {"notModified": True, "etag": etag}
+            return dict(labels.plain(getResults), etag=etag)
         else:
             return "No Results"
 
+    # GET request from API for the labels of a page of images
+    if action == "getLabelsBatch":
+        keys = parseKeys(event.get("keys"))
+        metrics.add("keys", len(keys))
+        return labels.plain(getLabelsBatch(keys))
+
+    # GET request from API for pre-signed URLs of the originals and thumbnails of a page of the
+    # caller's keys
+    if action == "getUrls":
+        keys = parseKeys(event.get("keys"))
+        metrics.add("keys", len(keys))
+        return getUrls(callerOwner(event), keys)
+
+    # GET request from API for the caller's images with a label, best matches first
+    if action == "searchByLabel":
+        limit = pageSize(event.get("limit"))
+        return searchByLabel(
+            callerOwner(event), event.get("label", ""), limit, event.get("cursor") or None
+        )
+
+    # GET request from API for a page of the caller's images, newest first
+    if action == "listImages":
+        limit = pageSize(event.get("limit"))
+        return listImages(callerOwner(event), limit, event.get("cursor") or None)
+
     # DELETE request from API
     if action == "deleteImage":
-        delResults = deleteImage(imageRequest)
+        delResults = deleteImage(callerOwner(event), imageRequest)
         return delResults
+
+    # DELETE request from API for a list of the caller's keys or everything under their prefix
+    if action == "deleteImages":
+        keys = parseKeys(event.get("keys"))
+        metrics.add("keys", len(keys))
+        return deleteImages(callerOwner(event), keys, event.get("prefix") or None)
     else:
         raise Exception("Action not detected or recognised")
 
 
+def callerOwner(event):
+
+    # Images are stored under private/<identity id>/, the id the identity pool gives a signed in
+    # user. The API's authorizer only checks the user pool token, so the same token is exchanged
+    # for the identity id, which GetId only returns for the user the token belongs to
+    sub = event.get("callerSub")
+    token = (event.get("idToken") or "").split(" ")[-1]
+    if not sub or not token:
+        raise Exception("Unauthorized")
+
+    owner = callerIdentities.get(sub)
+    if owner is None:
+        try:
+            response = clients.client("cognito-identity").get_id(
+                IdentityPoolId=os.environ["IDENTITY_POOL_ID"],
+                Logins={os.environ["IDENTITY_PROVIDER"]: token},
+            )
+        except ClientError as e:
+            logging.error(e)
+            raise Exception("Unauthorized")
+        owner = response["IdentityId"]
+        callerIdentities.put(sub, owner)
+    return owner
+
+
+def ownerPrefix(owner):
+    return f"private/{owner}/"
+
+
+def parseKeys(value):
+
+    # The keys parameter is either a JSON array of keys, or keys separated by commas with each
+    # key URL encoded so a comma in a key reads as %2C
+    if not value:
+        return []
+    if value.lstrip().startswith("["):
+        try:
+            keys = json.loads(value)
+        except ValueError:
+            raise Exception("keys must be a JSON array of strings")
+        if not isinstance(keys, list) or not all(isinstance(key, str) for key in keys):
+            raise Exception("keys must be a JSON array of strings")
+        return [key for key in keys if key]
+    return [unquote(key) for key in value.split(",") if key]
+
+
 def getLabelsFunction(image):
 
     key = image["key"]
 
-    # Instantiate a table resource object
-    imageLabelsTable = os.environ["TABLE"]
-    table = dynamodb.Table(imageLabelsTable)
+    # Hot images are answered from the cache. Images without labels yet aren't cached, the
+    # front end keeps asking until the Rekognition function has written them
+    item = labelsCache.get(key)
+    if item is not None:
+        metrics.add("labelsCacheHits")
+        return item
+    metrics.add("labelsCacheMisses")
 
     # Get item from table
 
     try:
-        response = table.get_item(Key={"image": key})
-        item = response["Item"]
+        response = getImageLabelsTable().get_item(Key={"image": key})
+        item = response.get("Item")
+        if item is None:
+            return {}
+        metrics.add("labelsCacheEvictions", labelsCache.put(key, item))
         return item
 
     except ClientError as e:
@@ -51,18 +203,170 @@ def getLabelsFunction(image):
         return "No labels or error"
 
 
-def deleteImage(image):
+def getLabelsBatch(keys, attributes=labelAttributes):
+
+    if len(keys) > maxBatchKeys:
+        raise Exception(f"At most {maxBatchKeys} keys can be requested at once")
+
+    # Only fetch the label attributes, unknown keys map to None
+    found, unread = tables.batchGetItems(getImageLabelsTable(), keys, attributes)
+    if unread:
+        raise Exception("Labels could not be read for all keys, please retry")
+    return {key: found.get(key) for key in keys}
+
+
+def getUrls(owner, keys):
+
+    if len(keys) > maxBatchKeys:
+        raise Exception(f"At most {maxBatchKeys} keys can be requested at once")
+    # The URLs are signed with the function's role, which can read every user's images, so only
+    # sign the caller's own
+    ownedPrefix = ownerPrefix(owner)
+    if not all(key.startswith(ownedPrefix) for key in keys):
+        raise Exception(f"Keys must be under {ownedPrefix}")
+
+    bucketName = os.environ["BUCKET"]
+    resizedBucketName = os.environ["RESIZEDBUCKET"]
+
+    # The label items name every rendition of an image. Images without one only have the
+    # thumbnail stored under the key of the original
+    items = getLabelsBatch(keys, ["image", "thumbnails"])
+
+    # generate_presigned_url signs locally with the credentials the memoized client resolved
+    # once, so a page of URLs costs no calls to AWS
+    s3 = clients.client("s3")
+
+    def sign(bucket, key):
+        return s3.generate_presigned_url(
+            "get_object", Params={"Bucket": bucket, "Key": key}, ExpiresIn=urlExpiry
+        )
+
+    urls = {}
+    for key in keys:
+        item = items.get(key) or {}
+        thumbnails = item.get("thumbnails") or [{"key": key, "name": "", "format": None}]
+        signed = [
+            {"name": t["name"], "format": t["format"], "url": sign(resizedBucketName, t["key"])}
+            for t in thumbnails
+        ]
+        urls[key] = {
+            "original": sign(bucketName, key),
+            "thumbnail": signed[0]["url"],
+            "thumbnails": signed,
+        }
+
+    metrics.add("signedUrls", sum(1 + len(u["thumbnails"]) for u in urls.values()))
+    return {"urls": urls, "expiresIn": urlExpiry}
+
+
+def pageSize(limit):
+
+    if not limit:
+        return defaultPageSize
+    try:
+        return max(1, min(int(limit), maxPageSize))
+    except ValueError:
+        raise Exception("limit must be a number")
+
+
+def searchByLabel(owner, label, limit, cursor=None):
+
+    if not label:
+        raise Exception("A label is required")
+    try:
+        startKey = labels.decodeCursor(cursor)
+    except ValueError as e:
+        raise Exception(str(e))
+
+    labelIndexTable = os.environ["LABEL_INDEX_TABLE"]
+    table = clients.resource("dynamodb").Table(labelIndexTable)
+
+    # One page of the owner's partition of the index for the label, highest confidence first
+    query = {
+        "KeyConditionExpression": "#l = :label",
+        "ProjectionExpression": "#i, #n, #c",
+        "ExpressionAttributeNames": {
+            "#l": "label",
+            "#i": "image",
+            "#n": "name",
+            "#c": "confidence",
+        },
+        "ExpressionAttributeValues": {":label": labels.indexKey(owner, label)},
+        "ScanIndexForward": False,
+        "Limit": limit,
+    }
+    if startKey:
+        query["ExclusiveStartKey"] = startKey
+
+    try:
+        response = table.query(**query)
+    except ClientError as e:
+        logging.error(e)
+        raise
+
+    metrics.add("results", len(response["Items"]))
+    return {
+        "images": labels.plain(response["Items"]),
+        "cursor": labels.encodeCursor(response.get("LastEvaluatedKey")),
+    }
+
+
+def listImages(owner, limit, cursor=None):
+
+    try:
+        startKey = labels.decodeCursor(cursor)
+    except ValueError as e:
+        raise Exception(str(e))
+
+    imageLabelsTable = os.environ["TABLE"]
+    table = clients.resource("dynamodb").Table(imageLabelsTable)
+
+    # One page of the owner's partition of the index, with the labels and thumbnails of each
+    # image, replaces listing the bucket and a getLabels call per image
+    query = {
+        "IndexName": ownerIndex,
+        "KeyConditionExpression": "#o = :owner",
+        "ExpressionAttributeNames": {"#o": "owner"},
+        "ExpressionAttributeValues": {":owner": owner},
+        "ScanIndexForward": False,
+        "Limit": limit,
+    }
+    if startKey:
+        query["ExclusiveStartKey"] = startKey
+
+    try:
+        response = table.query(**query)
+    except ClientError as e:
+        logging.error(e)
+        raise
+
+    metrics.add("results", len(response["Items"]))
+    return {
+        "images": labels.plain(response["Items"]),
+        "cursor": labels.encodeCursor(response.get("LastEvaluatedKey")),
+    }
+
+
+def deleteImage(owner, image):
 
     key = image["key"]
+    # Callers can only delete their own images
+    if not key.startswith(ownerPrefix(owner)):
+        raise Exception(f"Key must be under {ownerPrefix(owner)}")
+    labelsCache.invalidate([key])
 
     # Instantiate a table resource object
     imageLabelsTable = os.environ["TABLE"]
-    table = dynamodb.Table(imageLabelsTable)
+    table = clients.resource("dynamodb").Table(imageLabelsTable)
 
-    # Delete item from table
+    # Delete item from table, then the label index entries of its labels
 
+    renditionKeys = [key]
     try:
-        table.delete_item(Key={"image": key})
+        response = table.delete_item(Key={"image": key}, ReturnValues="ALL_OLD")
+        if "Attributes" in response:
+            deleteIndexEntries([response["Attributes"]])
+            renditionKeys = thumbnailKeys(key, response["Attributes"])
 
     except ClientError as e:
         logging.error(e)
@@ -70,13 +374,161 @@ def deleteImage(image):
     bucketName = os.environ["BUCKET"]
     resizedBucketName = os.environ["RESIZEDBUCKET"]
 
-    # Delete Photo and Thumbnail from Amazon S3
+    # Delete Photo and Thumbnails from Amazon S3
 
     try:
-        s3.Object(bucketName, key).delete()
-        s3.Object(resizedBucketName, key).delete()
+        clients.client("s3").delete_object(Bucket=bucketName, Key=key)
+        for thumbnailKey in renditionKeys:
+            clients.client("s3").delete_object(Bucket=resizedBucketName, Key=thumbnailKey)
 
     except ClientError as e:
         logging.error(e)
 
     return "Delete request successfully processed"
+
+
+def deleteImages(owner, keys, prefix=None):
+
+    bucketName = os.environ["BUCKET"]
+    resizedBucketName = os.environ["RESIZEDBUCKET"]
+
+    # Callers can only delete their own images
+    ownedPrefix = ownerPrefix(owner)
+    if prefix is not None and not prefix.startswith(ownedPrefix):
+        raise Exception(f"Prefix must be under {ownedPrefix}")
+    if not all(key.startswith(ownedPrefix) for key in keys):
+        raise Exception(f"Keys must be under {ownedPrefix}")
+
+    # Deletes on both buckets and the table run in parallel
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        if prefix is not None:
+            keys = listKeys(bucketName, prefix)
+            # Every rendition under the prefix, including those of images without a label item
+            resizedKeys = executor.submit(listKeys, resizedBucketName, prefix)
+
+        # The label items name the renditions of each image and the labels to unindex
+        items = readItems(keys)
+
+        # Rendition key -> key of its original, so a failed rendition fails the image
+        thumbnailsOf = {
+            thumbnailKey: key
+            for key in keys
+            for thumbnailKey in thumbnailKeys(key, (items or {}).get(key))
+        }
+        if prefix is not None:
+            # Renditions the label items don't name are stored under their original's key plus a
+            # suffix. Those whose original is already gone are reported under their own key
+            originalKeys = set(keys)
+            for thumbnailKey in resizedKeys.result():
+                thumbnailsOf.setdefault(thumbnailKey, originalOf(thumbnailKey, originalKeys))
+
+        originals = executor.submit(deleteObjects, bucketName, keys)
+        labelDeletes = executor.submit(deleteLabels, keys, items)
+        thumbnails = executor.submit(deleteObjects, resizedBucketName, list(thumbnailsOf))
+
+        errors = {}
+        for result in (originals, labelDeletes):
+            for key, message in result.result().items():
+                errors.setdefault(key, message)
+        # A rendition that could not be deleted fails the image it belongs to
+        for thumbnailKey, message in thumbnails.result().items():
+            errors.setdefault(thumbnailsOf.get(thumbnailKey, thumbnailKey), message)
+
+    # Per key outcome, "deleted" or the first error we got for it, and the renditions without an
+    # original that could not be deleted
+    labelsCache.invalidate(keys)
+    return dict(errors, **{key: errors.get(key, "deleted") for key in keys})
+
+
+def originalOf(thumbnailKey, originals):
+    # Longest of the original keys the rendition key starts with, the rendition key without one
+    for end in range(len(thumbnailKey), 0, -1):
+        if thumbnailKey[:end] in originals:
+            return thumbnailKey[:end]
+    return thumbnailKey
+
+
+def thumbnailKeys(key, item):
+    # Items written since the label item records its renditions name all of them, older ones
+    # only have the thumbnail stored under the key of the original
+    return [t["key"] for t in (item or {}).get("thumbnails", [])] or [key]
+
+
+def readItems(keys):
+
+    # Label items of the keys, None if they could not all be read
+    found, unread = tables.batchGetItems(
+        getImageLabelsTable(), keys, ["image", "labels", "thumbnails"]
+    )
+    if unread:
+        logging.error(f"Labels of {len(unread)} images could not be read")
+        return None
+    return found
+
+
+def listKeys(bucketName, prefix):
+
+    paginator = clients.client("s3").get_paginator("list_objects_v2")
+    return [
+        obj["Key"]
+        for page in paginator.paginate(Bucket=bucketName, Prefix=prefix)
+        for obj in page.get("Contents", [])
+    ]
+
+
+def deleteObjects(bucketName, keys):
+
+    # Returns the keys that could not be deleted with their error message
+    errors = {}
+    for start in range(0, len(keys), maxDeleteKeys):
+        chunk = keys[start : start + maxDeleteKeys]
+        try:
+            response = clients.client("s3").delete_objects(
+                Bucket=bucketName,
+                Delete={"Objects": [{"Key": key} for key in chunk], "Quiet": True},
+            )
+        except ClientError as e:
+            logging.error(e)
+            errors.update((key, str(e)) for key in chunk)
+            continue
+
+        for error in response.get("Errors", []):
+            errors[error["Key"]] = error["Message"]
+
+    return errors
+
+
+def deleteLabels(keys, items):
+
+    # Without the items their index entries can't be found, so keep the label items for a retry
+    if items is None:
+        return {key: "Labels could not be read, please retry" for key in keys}
+
+    imageLabelsTable = os.environ["TABLE"]
+    table = clients.resource("dynamodb").Table(imageLabelsTable)
+
+    # The label index entries go first, they can only be found through the labels of the item.
+    # batch_writer sends deletes 25 at a time and resends unprocessed ones
+    try:
+        deleteIndexEntries([item for item in items.values() if item])
+
+        with table.batch_writer(overwrite_by_pkeys=["image"]) as batch:
+            for key in keys:
+                batch.delete_item(Key={"image": key})
+    except Exception as e:
+        logging.error(e)
+        return {key: str(e) for key in keys}
+
+    return {}
+
+
+def deleteIndexEntries(items):
+
+    # Remove the label index entries of the labels of deleted label items
+    if not os.environ.get("LABEL_INDEX_TABLE"):
+        return
+    index = clients.resource("dynamodb").Table(os.environ["LABEL_INDEX_TABLE"])
+    with index.batch_writer(overwrite_by_pkeys=["label", "rank"]) as batch:
+        for item in items:
+            for key in labels.indexKeys(item["image"], item.get("labels", [])):
+                batch.delete_item(Key=key)
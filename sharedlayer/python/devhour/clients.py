@@ -0,0 +1,80 @@
+#
+# Lazily constructed, memoized AWS clients shared by the handlers of a container
+#
+
+import os
+import threading
+
+# boto3 and botocore take a good part of a cold start to import, so they are only imported
+# when the first client is actually needed
+_lock = threading.RLock()
+_clients = {}
+
+
+def _endpoint(service):
+    # <SERVICE>_ENDPOINT, e.g. DYNAMODB_ENDPOINT, points a service at a local stand-in
+    return os.environ.get(service.upper() + "_ENDPOINT")
+
+
+def _config(service=None):
+    from botocore.config import Config
+
+    # botocore's adaptive retry mode backs off and rate limits each client on throttling errors
+    config = Config(retries={"mode": "adaptive", "max_attempts": 3})
+    if service == "rekognition":
+        # rekognitionFunction's ThrottledCaller owns the retries of DetectLabels, so that every
+        # throttle goes through its rate limiter and counts towards its circuit breaker instead
+        # of being multiplied by SDK retries underneath
+        config = config.merge(Config(retries={"mode": "standard", "max_attempts": 0}))
+    if service == "s3":
+        # Pre-signed URLs need SigV4, and virtual hosted URLs on the regional endpoint are valid
+        # straight away in every region, without a redirect from the global endpoint
+        config = config.merge(Config(signature_version="s3v4", s3={"addressing_style": "virtual"}))
+    return config
+
+
+def client(service):
+    with _lock:
+        if ("client", service) not in _clients:
+            import boto3
+
+            options = {"endpoint_url": _endpoint(service), "config": _config(service)}
+            region = os.environ.get("AWS_REGION")
+            if options["endpoint_url"] is None and service == "s3" and region:
+                options.update(
+                    endpoint_url=f"https://s3.{region}.amazonaws.com", region_name=region
+                )
+            _clients[("client", service)] = boto3.client(service, **options)
+        return _clients[("client", service)]
+
+
+def resource(service):
+    with _lock:
+        if ("resource", service) not in _clients:
+            import boto3
+
+            _clients[("resource", service)] = boto3.resource(
+                service, endpoint_url=_endpoint(service), config=_config()
+            )
+        return _clients[("resource", service)]
+
+
+def override(kind, service, standIn):
+    # Install a stand-in for a client ("client") or resource ("resource"), e.g. a local fake
+    with _lock:
+        _clients[(kind, service)] = standIn
+
+
+def once(function):
+    # Memoize a zero argument factory, thread safe so worker threads never build it twice
+    lock = threading.Lock()
+    built = []
+
+    def wrapper():
+        if not built:
+            with lock:
+                if not built:
+                    built.append(function())
+        return built[0]
+
+    return wrapper
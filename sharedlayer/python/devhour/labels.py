@@ -0,0 +1,145 @@
+#
+# Label item schema and the inverted label index, shared by the Rekognition and service functions
+#
+# A label item keeps the flat object1..objectN attributes the front end has always read, plus a
+# "labels" list with the confidence, parents and bounding boxes of each label. Every label also
+# gets an entry in the label index table, partitioned by owner and label name and sorted by
+# confidence, so searching a user's images for a label is a Query instead of a Scan of the label
+# table, and never sees other users' images
+#
+
+import base64
+import binascii
+import hashlib
+import json
+from decimal import Decimal
+
+
+def toDecimal(value, places=2):
+    # DynamoDB numbers have to be Decimals, rounding keeps them short
+    return Decimal(str(round(value, places)))
+
+
+def labelList(rekognitionLabels):
+
+    # Rekognition's DetectLabels labels as the typed list stored on the label item
+    return [
+        {
+            "name": label["Name"],
+            "confidence": toDecimal(label["Confidence"]),
+            "parents": [parent["Name"] for parent in label.get("Parents", [])],
+            "instances": [
+                {
+                    "confidence": toDecimal(instance["Confidence"]),
+                    "boundingBox": {
+                        name[0].lower() + name[1:]: toDecimal(value, 4)
+                        for name, value in instance["BoundingBox"].items()
+                    },
+                }
+                for instance in label.get("Instances", [])
+            ],
+        }
+        for label in rekognitionLabels
+    ]
+
+
+def rankKey(confidence, image):
+    # Sort key of an index entry. Confidence in zero padded hundredths of a percent sorts the
+    # same as a string and as a number, so ScanIndexForward=False returns the best match first
+    return f"{int(round(Decimal(confidence) * 100)):05d}#{image}"
+
+
+def rankImage(rank):
+    return rank.split("#", 1)[1]
+
+
+def ownerOf(image):
+    # Amplify stores the uploads of a user under private/<sub>/
+    parts = image.split("/")
+    if len(parts) >= 3 and parts[0] == "private" and parts[1]:
+        return parts[1]
+    return None
+
+
+def indexKey(owner, name):
+    # Searches are case insensitive
+    return f"{owner}#{name.lower()}"
+
+
+def indexEntries(image, labels):
+
+    # Label index items for the labels list of an image. Only images with an owner are indexed
+    owner = ownerOf(image)
+    if owner is None:
+        return []
+    return [
+        {
+            "label": indexKey(owner, label["name"]),
+            "rank": rankKey(label["confidence"], image),
+            "image": image,
+            "name": label["name"],
+            "confidence": label["confidence"],
+        }
+        for label in labels
+    ]
+
+
+def indexKeys(image, labels):
+    return [
+        {"label": entry["label"], "rank": entry["rank"]} for entry in indexEntries(image, labels)
+    ]
+
+
+def encodeCursor(lastEvaluatedKey):
+
+    # Opaque pagination cursor for a Query's LastEvaluatedKey, None once there are no more pages
+    if not lastEvaluatedKey:
+        return None
+    content = json.dumps(plain(lastEvaluatedKey)).encode("utf-8")
+    return base64.urlsafe_b64encode(content).decode("ascii")
+
+
+def decodeCursor(cursor):
+
+    # ExclusiveStartKey for the page after the cursor, raises ValueError for a malformed one
+    if not cursor:
+        return None
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+    except (binascii.Error, UnicodeError, ValueError):
+        raise ValueError("Invalid cursor")
+    if not isinstance(key, dict) or not all(isinstance(value, str) for value in key.values()):
+        raise ValueError("Invalid cursor")
+    return key
+
+
+def itemETag(item):
+
+    # Strong ETag of a label item, computed the same way from the item being written and from
+    # the item read back, whose numbers have become Decimals
+    content = json.dumps(plain({k: v for k, v in item.items() if k != "etag"}), sort_keys=True)
+    return '"' + hashlib.sha256(content.encode("utf-8")).hexdigest()[:32] + '"'
+
+
+def etagMatches(etag, ifNoneMatch):
+
+    # If-None-Match holds "*" or a comma separated list of ETags, weak ones prefixed with W/
+    if not ifNoneMatch:
+        return False
+    for candidate in ifNoneMatch.split(","):
+        candidate = candidate.strip()
+        if candidate == "*" or candidate.replace("W/", "", 1) == etag:
+            return True
+    return False
+
+
+def plain(value):
+
+    # Items read from DynamoDB hold Decimals, which the Lambda runtime can't serialize to JSON
+    if isinstance(value, Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    if isinstance(value, dict):
+        return {key: plain(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [plain(item) for item in value]
+    return value
@@ -0,0 +1,65 @@
+#
+# Thread safe in-process LRU cache with an optional time to live, for what a warm container
+# can answer without a network call
+#
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class LruCache:
+    def __init__(self, maxItems, ttlSeconds=None):
+        self.maxItems = maxItems
+        self.ttlSeconds = ttlSeconds
+        # key -> (monotonic expiry or None, value), least recently used first
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+        self.counters = {"hits": 0, "misses": 0, "evictions": 0, "expirations": 0}
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.items.get(key)
+            if entry is not None and entry[0] is not None and entry[0] <= time.monotonic():
+                del self.items[key]
+                self.counters["expirations"] += 1
+                entry = None
+
+            if entry is None:
+                self.counters["misses"] += 1
+                return default
+            self.items.move_to_end(key)
+            self.counters["hits"] += 1
+            return entry[1]
+
+    def put(self, key, value):
+
+        # Returns how many least recently used entries were evicted to make room
+        if self.maxItems <= 0:
+            return 0
+        expires = time.monotonic() + self.ttlSeconds if self.ttlSeconds else None
+        evicted = 0
+        with self.lock:
+            self.items[key] = (expires, value)
+            self.items.move_to_end(key)
+            while len(self.items) > self.maxItems:
+                self.items.popitem(last=False)
+                evicted += 1
+            self.counters["evictions"] += evicted
+        return evicted
+
+    def invalidate(self, keys):
+        with self.lock:
+            for key in keys:
+                self.items.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+    def __len__(self):
+        return len(self.items)
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters, size=len(self.items))
@@ -0,0 +1,146 @@
+#
+# Per invocation metrics written as one CloudWatch Embedded Metric Format (EMF) log line
+#
+
+import json
+import os
+import random
+import resource
+import threading
+import time
+from contextlib import contextmanager
+
+NAMESPACE = os.environ.get("METRICS_NAMESPACE", "AwsDevHour")
+# Cold start import time we expect to stay under, exceeding it is logged as a warning
+INIT_BUDGET_MS = float(os.environ.get("INIT_BUDGET_MS", "500"))
+# Fraction of invocations that emit metrics, 1 emits all of them
+SAMPLE_RATE = float(os.environ.get("METRICS_SAMPLE_RATE", "1"))
+
+# Lambda runs one invocation at a time per container, so the recorder is module level and
+# shared by all the worker threads of the current invocation
+_lock = threading.Lock()
+_coldStart = True
+_service = None
+_sampled = False
+_started = 0.0
+_values = {}
+_units = {}
+_properties = {}
+# Milliseconds spent importing each module group, reported with the first invocation
+_imports = {}
+
+
+def begin(service, **properties):
+
+    # Start recording a new invocation, deciding once whether it's sampled. Cold starts are
+    # always sampled so their init time can be tracked as a benchmark
+    global _service, _sampled, _started, _values, _units, _properties
+    with _lock:
+        _service = service
+        _sampled = _coldStart or random.random() < SAMPLE_RATE
+        _started = time.perf_counter()
+        _values = {}
+        _units = {}
+        _properties = {name: value for name, value in properties.items() if value is not None}
+
+
+# EMF accepts at most 100 values per metric
+MAX_VALUES = 100
+
+
+def put(name, value, unit="Count"):
+
+    # Samples of the same metric are kept as a list, CloudWatch keeps their distribution
+    if not _sampled:
+        return
+    with _lock:
+        values = _values.setdefault(name, [])
+        if len(values) < MAX_VALUES:
+            values.append(value)
+        _units[name] = unit
+
+
+def add(name, value=1, unit="Count"):
+
+    # Totals such as byte, pixel or hit counts are summed over the invocation
+    if not _sampled:
+        return
+    with _lock:
+        _values[name] = [_values.get(name, [0])[0] + value]
+        _units[name] = unit
+
+
+@contextmanager
+def timer(stage):
+
+    # Records the elapsed milliseconds of the block as the <stage>Time metric
+    if not _sampled:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        put(stage + "Time", round((time.perf_counter() - start) * 1000, 2), "Milliseconds")
+
+
+@contextmanager
+def importTimer(module):
+
+    # Times a module level import, always recorded since it only happens on a cold start
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _imports[module] = round((time.perf_counter() - start) * 1000, 2)
+
+
+def flush():
+
+    # Print the EMF line for this invocation, cold start and peak memory included
+    global _coldStart
+    coldStart, _coldStart = _coldStart, False
+
+    if not _sampled:
+        return
+
+    if coldStart and _imports:
+        initTime = round(sum(_imports.values()), 2)
+        if initTime > INIT_BUDGET_MS:
+            print(
+                f"Cold start imports took {initTime} ms, over the {INIT_BUDGET_MS} ms budget: ",
+                _imports,
+            )
+        for module, elapsed in _imports.items():
+            put(f"import{module[:1].upper()}{module[1:]}Time", elapsed, "Milliseconds")
+        put("initTime", initTime, "Milliseconds")
+
+    put("invocationTime", round((time.perf_counter() - _started) * 1000, 2), "Milliseconds")
+    # ru_maxrss is in kilobytes on Linux
+    put("peakRss", resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024, "Megabytes")
+
+    with _lock:
+        document = dict(_properties)
+        document.update(
+            (name, values[0] if len(values) == 1 else values) for name, values in _values.items()
+        )
+        document.update(
+            {
+                "_aws": {
+                    "Timestamp": int(time.time() * 1000),
+                    "CloudWatchMetrics": [
+                        {
+                            "Namespace": NAMESPACE,
+                            "Dimensions": [["Service"], ["Service", "ColdStart"]],
+                            "Metrics": [
+                                {"Name": name, "Unit": unit} for name, unit in _units.items()
+                            ],
+                        }
+                    ],
+                },
+                "Service": _service,
+                "ColdStart": str(coldStart).lower(),
+            }
+        )
+
+    print(json.dumps(document, default=str))
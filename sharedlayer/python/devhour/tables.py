@@ -0,0 +1,54 @@
+#
+# DynamoDB batch reads shared by the Rekognition and service functions
+#
+
+import logging
+import random
+import time
+
+from botocore.exceptions import ClientError
+
+# DynamoDB caps batch_get_item at 100 keys per request
+MAX_BATCH_GET_KEYS = 100
+
+
+def batchGetItems(table, images, attributes, maxAttempts=5):
+
+    # Reads the attributes of the items of the images 100 keys at a time, retrying the keys
+    # DynamoDB leaves unprocessed with jittered exponential backoff. Returns the items found by
+    # image and the images that could not be read, callers decide whether that is an error
+    found = {}
+    unread = set()
+    # batch_get_item rejects a request that names a key twice
+    images = list(dict.fromkeys(images))
+    names = {f"#a{n}": attribute for n, attribute in enumerate(attributes)}
+    for start in range(0, len(images), MAX_BATCH_GET_KEYS):
+        chunk = images[start : start + MAX_BATCH_GET_KEYS]
+        request = {
+            table.name: {
+                "Keys": [{"image": image} for image in chunk],
+                "ProjectionExpression": ", ".join(names),
+                "ExpressionAttributeNames": names,
+            }
+        }
+
+        for attempt in range(maxAttempts):
+            if attempt:
+                time.sleep(random.uniform(0, 0.05 * 2**attempt))
+            try:
+                response = table.meta.client.batch_get_item(RequestItems=request)
+            except ClientError as e:
+                logging.error(e)
+                unread.update(chunk)
+                request = None
+                break
+            for item in response["Responses"].get(table.name, []):
+                found[item["image"]] = item
+            request = response.get("UnprocessedKeys")
+            if not request:
+                break
+
+        if request:
+            unread.update(key["image"] for key in request[table.name]["Keys"])
+
+    return found, unread